@@ -1,43 +1,373 @@
-from flask import Flask, render_template, request, redirect, flash, session, url_for
+from flask import Flask, Response, g, render_template, request, redirect, flash, session, stream_with_context, url_for
+from flask.json.provider import DefaultJSONProvider
 import sqlite3
 import os
-import heapq
+import re
+import sys
 import collections
-from datetime import datetime, timedelta
+import functools
+import hashlib
+import html
+import itertools
+import logging
+import logging.handlers
+import atexit
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
 from abc import ABC, abstractmethod
 import math
+import operator
+import numpy as np
+import queue
+import time
+import threading
+from contextlib import contextmanager
+from io import BytesIO
+
+try:
+    from numba import njit  # Optional: JIT-compiles the Haversine kernel when installed
+except ImportError:
+    njit = None
+
+try:
+    from PIL import Image, ImageColor, ImageDraw, ImageFont
+except ImportError:  # Optional: the PNG chart routes answer 500 without it
+    Image = None
 
 # ---------------- DATABASE MANAGER CLASS (ENCAPSULATION & ABSTRACTION) ----------------
 # Encapsulation: Hides database connection details and provides a clean interface
 # Abstraction: Abstracts database operations into methods
 
+class PooledConnection:
+    """Connection checked out of the pool; close() hands it back instead of closing it"""
+    def __init__(self, manager, conn, writer=False):
+        self._manager = manager
+        self._conn = conn
+        self.writer = writer  # holds the database's writer lock until closed
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    @property
+    def closed(self):
+        return self._conn is None
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            if self.writer:
+                self._manager.release_write(conn)
+            else:
+                self._manager.release(conn)
+
 class DatabaseManager:
+    POOL_SIZE = 8
+    STATEMENT_CACHE_SIZE = 256  # prepared statements kept per connection
+    # WAL is persistent in the database file, so it is only switched on by the first connection
+    WAL_PRAGMA = "PRAGMA journal_mode=WAL"
+    PRAGMAS = (
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-65536",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA busy_timeout=5000",  # wait for a competing writer instead of raising SQLITE_BUSY
+    )
+    # Check-ins between PRAGMA optimize runs, so query planner stats stay fresh
+    OPTIMIZE_EVERY = 500
+
+    # Idempotent schema upgrades applied by ensure_schema() at startup
+    INDEXES = (
+        "CREATE INDEX IF NOT EXISTS idx_appt_patient_status_dt ON appointments(patient_id, status, dt)",
+        "CREATE INDEX IF NOT EXISTS idx_appt_pat_status_date_time ON appointments(patient_id, status, date, time)",
+        "CREATE INDEX IF NOT EXISTS idx_appt_doc_status_date_time ON appointments(doctor_id, status, date, time)",
+        "CREATE INDEX IF NOT EXISTS idx_notif_user_type_created ON notifications(user_id, type, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_notif_user_unread ON notifications(user_id, read) WHERE read=0",
+        "CREATE INDEX IF NOT EXISTS idx_payments_appt_status ON payments(appointment_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_doctors_complete_specialty ON doctors(profile_complete, specialty COLLATE NOCASE)",
+        "CREATE INDEX IF NOT EXISTS idx_doctors_user ON doctors(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments(user_id, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_notif_appt_type ON notifications(appointment_id, type)",
+        # Widened to (appointment_id, created_at) so per-appointment lists come back pre-sorted
+        "DROP INDEX IF EXISTS idx_prescriptions_appt",
+        "CREATE INDEX IF NOT EXISTS idx_prescriptions_appt_created ON prescriptions(appointment_id, created_at)",
+        # Vitals charts read a user's rows in (date, id) order; id is the rowid every index entry ends with
+        "CREATE INDEX IF NOT EXISTS idx_weight_user_date ON weight_tracking(user_id, date)",
+        # Walked backwards for newest-first lists, ties broken by id (rowid) the same way
+        "CREATE INDEX IF NOT EXISTS idx_notif_user_created ON notifications(user_id, created_at)",
+    )
+
+    # Distinct accepted patients per doctor, kept current by triggers on appointments.
+    # doctor_patient_visits counts accepted appointments per (doctor, patient) pair;
+    # doctor_patient_counts.patients changes only when a pair appears or disappears.
+    PATIENT_COUNT_SCHEMA = """
+        BEGIN;
+        CREATE TABLE doctor_patient_visits (
+            doctor_id INTEGER NOT NULL,
+            patient_id INTEGER NOT NULL,
+            visits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (doctor_id, patient_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE doctor_patient_counts (
+            doctor_id INTEGER PRIMARY KEY,
+            patients INTEGER NOT NULL DEFAULT 0
+        );
+
+        INSERT INTO doctor_patient_visits (doctor_id, patient_id, visits)
+            SELECT doctor_id, patient_id, COUNT(*) FROM appointments
+            WHERE status='accepted' GROUP BY doctor_id, patient_id;
+        INSERT INTO doctor_patient_counts (doctor_id, patients)
+            SELECT doctor_id, COUNT(*) FROM doctor_patient_visits GROUP BY doctor_id;
+
+        CREATE TRIGGER appt_patient_link_ins AFTER INSERT ON appointments
+        WHEN NEW.status='accepted'
+        BEGIN
+            INSERT OR IGNORE INTO doctor_patient_counts (doctor_id, patients) VALUES (NEW.doctor_id, 0);
+            UPDATE doctor_patient_counts SET patients = patients + 1
+            WHERE doctor_id=NEW.doctor_id AND NOT EXISTS (
+                SELECT 1 FROM doctor_patient_visits WHERE doctor_id=NEW.doctor_id AND patient_id=NEW.patient_id);
+            INSERT INTO doctor_patient_visits (doctor_id, patient_id, visits) VALUES (NEW.doctor_id, NEW.patient_id, 1)
+            ON CONFLICT(doctor_id, patient_id) DO UPDATE SET visits = visits + 1;
+        END;
+
+        CREATE TRIGGER appt_patient_link_upd AFTER UPDATE OF status, doctor_id, patient_id ON appointments
+        WHEN NEW.status='accepted'
+        BEGIN
+            INSERT OR IGNORE INTO doctor_patient_counts (doctor_id, patients) VALUES (NEW.doctor_id, 0);
+            UPDATE doctor_patient_counts SET patients = patients + 1
+            WHERE doctor_id=NEW.doctor_id AND NOT EXISTS (
+                SELECT 1 FROM doctor_patient_visits WHERE doctor_id=NEW.doctor_id AND patient_id=NEW.patient_id);
+            INSERT INTO doctor_patient_visits (doctor_id, patient_id, visits) VALUES (NEW.doctor_id, NEW.patient_id, 1)
+            ON CONFLICT(doctor_id, patient_id) DO UPDATE SET visits = visits + 1;
+        END;
+
+        CREATE TRIGGER appt_patient_unlink_upd AFTER UPDATE OF status, doctor_id, patient_id ON appointments
+        WHEN OLD.status='accepted'
+        BEGIN
+            UPDATE doctor_patient_visits SET visits = visits - 1
+            WHERE doctor_id=OLD.doctor_id AND patient_id=OLD.patient_id;
+            UPDATE doctor_patient_counts SET patients = patients - 1
+            WHERE doctor_id=OLD.doctor_id AND EXISTS (
+                SELECT 1 FROM doctor_patient_visits
+                WHERE doctor_id=OLD.doctor_id AND patient_id=OLD.patient_id AND visits <= 0);
+            DELETE FROM doctor_patient_visits
+            WHERE doctor_id=OLD.doctor_id AND patient_id=OLD.patient_id AND visits <= 0;
+        END;
+
+        CREATE TRIGGER appt_patient_unlink_del AFTER DELETE ON appointments
+        WHEN OLD.status='accepted'
+        BEGIN
+            UPDATE doctor_patient_visits SET visits = visits - 1
+            WHERE doctor_id=OLD.doctor_id AND patient_id=OLD.patient_id;
+            UPDATE doctor_patient_counts SET patients = patients - 1
+            WHERE doctor_id=OLD.doctor_id AND EXISTS (
+                SELECT 1 FROM doctor_patient_visits
+                WHERE doctor_id=OLD.doctor_id AND patient_id=OLD.patient_id AND visits <= 0);
+            DELETE FROM doctor_patient_visits
+            WHERE doctor_id=OLD.doctor_id AND patient_id=OLD.patient_id AND visits <= 0;
+        END;
+        COMMIT;
+    """
+
+    # Unread notifications per user, kept on the users row by triggers on notifications
+    UNREAD_COUNT_SCHEMA = """
+        BEGIN;
+        ALTER TABLE users ADD COLUMN unread_notifications INTEGER NOT NULL DEFAULT 0;
+        UPDATE users SET unread_notifications = (
+            SELECT COUNT(*) FROM notifications n WHERE n.user_id=users.id AND n.read=0);
+
+        CREATE TRIGGER notif_unread_ins AFTER INSERT ON notifications
+        WHEN NEW.read=0
+        BEGIN
+            UPDATE users SET unread_notifications = unread_notifications + 1 WHERE id=NEW.user_id;
+        END;
+
+        CREATE TRIGGER notif_unread_upd_old AFTER UPDATE OF read, user_id ON notifications
+        WHEN OLD.read=0
+        BEGIN
+            UPDATE users SET unread_notifications = unread_notifications - 1 WHERE id=OLD.user_id;
+        END;
+
+        CREATE TRIGGER notif_unread_upd_new AFTER UPDATE OF read, user_id ON notifications
+        WHEN NEW.read=0
+        BEGIN
+            UPDATE users SET unread_notifications = unread_notifications + 1 WHERE id=NEW.user_id;
+        END;
+
+        CREATE TRIGGER notif_unread_del AFTER DELETE ON notifications
+        WHEN OLD.read=0
+        BEGIN
+            UPDATE users SET unread_notifications = unread_notifications - 1 WHERE id=OLD.user_id;
+        END;
+        COMMIT;
+    """
+
+    # One consultation note per appointment, so save_notes can upsert on appointment_id.
+    # Earlier saves appended rows; only the latest one per appointment is kept.
+    NOTES_UNIQUE_SCHEMA = """
+        BEGIN;
+        DELETE FROM consultation_notes
+        WHERE appointment_id IS NOT NULL AND id NOT IN (
+            SELECT MAX(id) FROM consultation_notes GROUP BY appointment_id);
+        CREATE UNIQUE INDEX idx_notes_appt ON consultation_notes(appointment_id);
+        COMMIT;
+    """
+
+    # Connection pools are shared by every manager that points at the same file
+    _pools = {}
+    _write_locks = {}  # one writer at a time per database file
+    _pools_lock = threading.Lock()
+    _checkins = itertools.count(1)
+    _wal_enabled = set()  # database paths already switched to WAL
+
     def __init__(self, db_path='database.db'):
         self.db_path = db_path
-
-    def get_connection(self):
-        """Encapsulated database connection method"""
-        conn = sqlite3.connect(self.db_path)
+        with DatabaseManager._pools_lock:
+            if db_path not in DatabaseManager._pools:
+                DatabaseManager._pools[db_path] = queue.Queue(maxsize=self.POOL_SIZE)
+                DatabaseManager._write_locks[db_path] = threading.Lock()
+            self._pool = DatabaseManager._pools[db_path]
+            self._write_lock = DatabaseManager._write_locks[db_path]
+
+    def _connect(self):
+        """Open a new long-lived connection with the pool PRAGMAs applied"""
+        # detect_types=0: values come back as stored, no declared-type converters are consulted
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, detect_types=0,
+                               cached_statements=self.STATEMENT_CACHE_SIZE)
         conn.row_factory = sqlite3.Row
+        if self.db_path not in DatabaseManager._wal_enabled:
+            conn.execute(self.WAL_PRAGMA)
+            DatabaseManager._wal_enabled.add(self.db_path)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
         return conn
-    def execute_query(self, query, params=(), fetch_one=False, fetch_all=False):
-        """Abstracted query execution with error handling"""
-        conn = self.get_connection()
+
+    def acquire(self):
+        """Take an idle connection from the pool, opening one if none is free"""
         try:
-            result = conn.execute(query, params)
-            if fetch_one:
-                return result.fetchone()
-            elif fetch_all:
-                return result.fetchall()
-            else:
-                conn.commit()
-                return result.lastrowid
-        except Exception as e:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        """Return a connection to the pool, discarding any unfinished transaction"""
+        if conn.in_transaction:
             conn.rollback()
-            raise e
-        finally:
+        conn.row_factory = sqlite3.Row
+        if next(DatabaseManager._checkins) % self.OPTIMIZE_EVERY == 0:
+            conn.execute("PRAGMA optimize")
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.execute("PRAGMA optimize")
             conn.close()
 
+    def acquire_read(self):
+        """Connection for a read-only request"""
+        return self.acquire()
+
+    def acquire_write(self):
+        """Connection for a writing request; blocks while another writer holds the lock"""
+        self._write_lock.acquire()
+        try:
+            return self.acquire()
+        except BaseException:
+            self._write_lock.release()
+            raise
+
+    def release_write(self, conn):
+        """Return a writer connection and let the next writer in"""
+        try:
+            self.release(conn)
+        finally:
+            self._write_lock.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def ensure_schema(self):
+        """Add derived columns and indexes the queries rely on (safe to run repeatedly)"""
+        with self.connection() as conn:
+            # table_xinfo (unlike table_info) also lists generated columns
+            columns = {row['name'] for row in conn.execute("PRAGMA table_xinfo(appointments)")}
+            if not columns:
+                return  # Empty database, nothing to upgrade
+
+            if 'dt' not in columns:
+                # 'YYYY-MM-DD HH:MM' so date/time cutoffs compare as one string
+                conn.execute("""
+                    ALTER TABLE appointments
+                    ADD COLUMN dt TEXT GENERATED ALWAYS AS (date || ' ' || time) VIRTUAL
+                """)
+
+            has_patient_counts = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='doctor_patient_counts'"
+            ).fetchone()
+            if not has_patient_counts:
+                # Creates, backfills and installs the triggers in one transaction
+                conn.executescript(self.PATIENT_COUNT_SCHEMA)
+
+            user_columns = {row['name'] for row in conn.execute("PRAGMA table_xinfo(users)")}
+            if 'unread_notifications' not in user_columns:
+                conn.executescript(self.UNREAD_COUNT_SCHEMA)
+
+            has_notes_key = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_notes_appt'"
+            ).fetchone()
+            if not has_notes_key:
+                conn.executescript(self.NOTES_UNIQUE_SCHEMA)
+
+            count_sql = "SELECT COUNT(*) FROM sqlite_master WHERE type='index'"
+            index_count = conn.execute(count_sql).fetchone()[0]
+            for index_sql in self.INDEXES:
+                conn.execute(index_sql)
+            conn.commit()
+
+            # Refresh planner statistics whenever new indexes were created
+            if conn.execute(count_sql).fetchone()[0] != index_count:
+                conn.execute("ANALYZE")
+
+    def get_connection(self, write=False):
+        """Encapsulated database connection method (returned to the pool on close).
+        write=True serializes writers in the app instead of contending inside SQLite."""
+        if write:
+            return PooledConnection(self, self.acquire_write(), writer=True)
+        return PooledConnection(self, self.acquire_read())
+
+    def execute_query(self, query, params=(), fetch_one=False, fetch_all=False, row_factory=sqlite3.Row):
+        """Abstracted query execution with error handling.
+        Pass row_factory=None to get plain tuples (cheaper for scalar lookups)."""
+        with self.connection() as conn:
+            try:
+                conn.row_factory = row_factory
+                result = conn.execute(query, params)
+                if fetch_one:
+                    return result.fetchone()
+                elif fetch_all:
+                    return result.fetchall()
+                else:
+                    conn.commit()
+                    return result.lastrowid
+            except Exception as e:
+                conn.rollback()
+                raise e
+
+# ---------------- REQUEST TIME CONTEXT ----------------
+# Greeting for every hour of the day, precomputed once (Data Structure: Tuple lookup table)
+_GREETINGS = tuple(
+    "Good Morning" if hour < 12 else "Good Afternoon" if hour < 17 else "Good Evening"
+    for hour in range(24)
+)
+
+def _now_context():
+    """Current time, its date ('%Y-%m-%d') and time ('%H:%M') strings and the greeting"""
+    now = datetime.now()
+    return now, now.strftime('%Y-%m-%d'), now.strftime('%H:%M'), _GREETINGS[now.hour]
+
 # ---------------- USER BASE CLASS (INHERITANCE & POLYMORPHISM) ----------------
 # Inheritance: Base class for all user types
 # Polymorphism: Different user types can have different behaviors
@@ -79,28 +409,26 @@ class Patient(User):
 
     def get_dashboard_data(self):
         """Polymorphic implementation for patient dashboard"""
-        now = datetime.now()
-        current_date = now.strftime('%Y-%m-%d')
+        now, current_date, current_time, greeting = _now_context()
+        cutoff = f"{current_date} {current_time}"
 
         # Get upcoming appointments
         upcoming = self.db.execute_query("""
             SELECT a.*, d.fname as doctor_fname, d.lname as doctor_lname, d.specialty
             FROM appointments a
             JOIN doctors d ON a.doctor_id = d.id
-            WHERE a.patient_id=? AND a.status='accepted' AND
-            (a.date > ? OR (a.date = ? AND a.time > ?))
-            ORDER BY a.date, a.time
-        """, (self.user_id, current_date, current_date, now.strftime('%H:%M')), fetch_all=True)
+            WHERE a.patient_id=? AND a.status='accepted' AND a.dt > ?
+            ORDER BY a.dt
+        """, (self.user_id, cutoff), fetch_all=True)
 
         # Get past appointments
         past = self.db.execute_query("""
             SELECT a.*, d.fname as doctor_fname, d.lname as doctor_lname, d.specialty
             FROM appointments a
             JOIN doctors d ON a.doctor_id = d.id
-            WHERE a.patient_id=? AND
-            (a.date < ? OR (a.date = ? AND a.time <= ?))
-            ORDER BY a.date DESC, a.time DESC LIMIT 5
-        """, (self.user_id, current_date, current_date, now.strftime('%H:%M')), fetch_all=True)
+            WHERE a.patient_id=? AND a.dt <= ?
+            ORDER BY a.dt DESC LIMIT 5
+        """, (self.user_id, cutoff), fetch_all=True)
 
         # Get notifications
         notifications = self.db.execute_query("""
@@ -109,10 +437,6 @@ class Patient(User):
             ORDER BY created_at DESC LIMIT 5
         """, (self.user_id,), fetch_all=True)
 
-        # Determine greeting
-        current_hour = now.hour
-        greeting = "Good Morning" if current_hour < 12 else "Good Afternoon" if current_hour < 17 else "Good Evening"
-
         return {
             'name': self.fname,
             'greeting': greeting,
@@ -135,8 +459,9 @@ class Doctor(User):
         today = datetime.now().strftime('%Y-%m-%d')
 
         # Get doctor's ID
-        doctor_record = self.db.execute_query("SELECT id FROM doctors WHERE user_id=?", (self.user_id,), fetch_one=True)
-        doctor_id = doctor_record['id'] if doctor_record else None
+        doctor_record = self.db.execute_query("SELECT id FROM doctors WHERE user_id=?", (self.user_id,),
+                                              fetch_one=True, row_factory=None)
+        doctor_id = doctor_record[0] if doctor_record else None
 
         if not doctor_id:
             return {'profile_complete': 0, 'profile_percent': 25}
@@ -163,7 +488,7 @@ class Doctor(User):
         total_patients = self.db.execute_query("""
             SELECT COUNT(DISTINCT patient_id) as count FROM appointments
             WHERE doctor_id=? AND status IN ('accepted', 'pending')
-        """, (doctor_id,), fetch_one=True)['count']
+        """, (doctor_id,), fetch_one=True, row_factory=None)[0]
 
         return {
             'name': self.fname,
@@ -175,8 +500,27 @@ class Doctor(User):
         }
 
 # ---------------- APPOINTMENT MANAGER CLASS (ENCAPSULATION) ----------------
+_DOCTOR_APPTS_SQL = """
+            SELECT a.*, u.fname as patient_fname, u.lname as patient_lname,
+                   strftime('%Y-%m-%d', a.date) as date_str
+            FROM appointments a
+            JOIN users u ON a.patient_id = u.id
+            WHERE a.doctor_id=?
+        """
+
+
+def _doctor_appts_query(n):
+    """Full doctor-appointments query text for a status filter of size n"""
+    in_clause = " AND a.status IN ({})".format(','.join('?' * n)) if n else ""
+    return _DOCTOR_APPTS_SQL + in_clause + " ORDER BY a.date, a.time"
+
+
 # Encapsulation: Manages all appointment-related operations
 class AppointmentManager:
+    # Query text for the common status filter sizes, built once at class load so
+    # repeated calls reuse the same string and hit the statement cache
+    _QTPL = {n: _doctor_appts_query(n) for n in range(5)}
+
     def __init__(self):
         self.db = DatabaseManager()
 
@@ -189,26 +533,29 @@ class AppointmentManager:
 
     def get_appointments_by_doctor(self, doctor_id, status_filter=None):
         """Get appointments for a doctor with optional status filter"""
-        query = """
-            SELECT a.*, u.fname as patient_fname, u.lname as patient_lname,
-                   strftime('%Y-%m-%d', a.date) as date_str
-            FROM appointments a
-            JOIN users u ON a.patient_id = u.id
-            WHERE a.doctor_id=?
-        """
-        params = [doctor_id]
-
-        if status_filter:
-            query += " AND a.status IN ({})".format(','.join('?' * len(status_filter)))
-            params.extend(status_filter)
-
-        query += " ORDER BY a.date, a.time"
-        return self.db.execute_query(query, tuple(params), fetch_all=True)
+        statuses = tuple(status_filter or ())
+        query = self._QTPL.get(len(statuses)) or _doctor_appts_query(len(statuses))
+        return self.db.execute_query(query, (doctor_id, *statuses), fetch_all=True)
 
     def update_appointment_status(self, appointment_id, status):
         """Update appointment status"""
         self.db.execute_query("UPDATE appointments SET status=? WHERE id=?", (status, appointment_id))
 
+# ---------------- HAVERSINE KERNEL ----------------
+def _haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km between two validated coordinates"""
+    R = 6371.0  # Earth's radius in km
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2)**2
+    a = min(max(a, 0.0), 1.0)
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    return R * c
+
+if njit is not None:
+    _haversine = njit(cache=True, fastmath=True)(_haversine)
+    _haversine(0.0, 0.0, 0.0, 0.0)  # Compile (or load from cache) at startup, not on first request
+
 # ---------------- DISTANCE CALCULATOR CLASS (ABSTRACTION & ENCAPSULATION) ----------------
 # Abstraction: Hides complex distance calculation logic
 # Encapsulation: Contains all distance-related methods
@@ -241,38 +588,28 @@ class DistanceCalculator:
                         if lat1 == lat2 and lon1 == lon2:
                             return 0.1
 
-                        R = 6371  # Earth's radius in km
-                        dlat = math.radians(lat2 - lat1)
-                        dlon = math.radians(lon2 - lon1)
-                        a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2)**2
-                        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-                        return max(R * c, 0.1)
+                        return max(_haversine(lat1, lon1, lat2, lon2), 0.1)
                 except (ValueError, TypeError, ZeroDivisionError):
                     pass  # Fall through to text-based calculation
 
-            # Text similarity fallback
-            patient_city = (patient_addr.get('city') or '').split(',')[0].lower().strip()
-            doctor_city = (doctor_addr.get('city') or '').split(',')[0].lower().strip()
+            # Text similarity fallback on canonical keys, computed once per address
+            patient_keys = patient_addr.get('text_keys') or DistanceCalculator.text_keys(patient_addr)
+            doctor_keys = doctor_addr.get('text_keys') or DistanceCalculator.text_keys(doctor_addr)
+            patient_city, patient_state, patient_region, patient_district = patient_keys
+            doctor_city, doctor_state, doctor_region, doctor_district = doctor_keys
 
             if patient_city == doctor_city and patient_city:
                 return 0.1
 
-
             # State-based fallback
-            patient_state = (patient_addr.get('state') or '').lower().strip()
-            doctor_state = (doctor_addr.get('state') or '').lower().strip()
-
             if patient_state == doctor_state and patient_state:
                 return 100.0  # Default intra-state distance
 
             # Pincode-based fallback (rough estimate)
-            patient_pincode = (patient_addr.get('pincode') or '').strip()
-            doctor_pincode = (doctor_addr.get('pincode') or '').strip()
-
-            if patient_pincode and doctor_pincode and len(patient_pincode) >= 3 and len(doctor_pincode) >= 3:
-                if patient_pincode[:3] == doctor_pincode[:3]:
+            if patient_region is not None and doctor_region is not None:
+                if patient_region == doctor_region:
                     return 50.0  # Same region
-                elif patient_pincode[:2] == doctor_pincode[:2]:
+                elif patient_district == doctor_district:
                     return 150.0  # Same state/district
 
             return 200.0  # Default inter-state distance
@@ -281,37 +618,116 @@ class DistanceCalculator:
             # Last resort fallback - never return -1
             return 150.0
 
+    @staticmethod
+    def _pincode_prefix(prefix):
+        """Numeric pincode prefix as an int so matches are a single integer compare"""
+        return int(prefix) if prefix.isascii() and prefix.isdigit() else prefix
+
+    @staticmethod
+    def text_keys(addr):
+        """
+        Canonical (city, state, region, district) keys for the text fallback,
+        cached on the address dict so each record is normalized only once.
+        City/state are interned lowercase strings; region/district are the
+        first 3/2 pincode characters (None when the pincode is shorter than 3).
+        """
+        city = sys.intern((addr.get('city') or '').split(',')[0].lower().strip())
+        state = sys.intern((addr.get('state') or '').lower().strip())
+        pincode = str(addr.get('pincode') or '').strip()
+        if len(pincode) >= 3:
+            region = DistanceCalculator._pincode_prefix(pincode[:3])
+            district = DistanceCalculator._pincode_prefix(pincode[:2])
+        else:
+            region = district = None
+        keys = addr['text_keys'] = (city, state, region, district)
+        return keys
+
+    @staticmethod
+    def _coordinate(value):
+        """Parse a stored coordinate, NaN when missing or not numeric"""
+        try:
+            return float(value)
+        except (ValueError, TypeError):
+            return math.nan
+
+    @staticmethod
+    def calculate_distances(origin_addr, records, to_addr=dict, lat_key='latitude', lon_key='longitude'):
+        """
+        Distance from one address to many records (rows or dicts with
+        lat_key/lon_key coordinate columns), vectorized with NumPy.
+        Rows without usable coordinates fall back to calculate_distance on
+        to_addr(record), so address dicts are only built for those rows.
+        Uses Data Structure: NumPy arrays of latitudes/longitudes
+        """
+        n = len(records)
+        lat1 = DistanceCalculator._coordinate(origin_addr.get('latitude'))
+        lon1 = DistanceCalculator._coordinate(origin_addr.get('longitude'))
+
+        if -90 <= lat1 <= 90 and -180 <= lon1 <= 180:
+            lats = np.fromiter((DistanceCalculator._coordinate(r[lat_key]) for r in records),
+                               dtype=np.float64, count=n)
+            lons = np.fromiter((DistanceCalculator._coordinate(r[lon_key]) for r in records),
+                               dtype=np.float64, count=n)
+            # NaN compares False, so missing/non-numeric coordinates are excluded here
+            valid = (np.abs(lats) <= 90) & (np.abs(lons) <= 180)
+
+            R = 6371  # Earth's radius in km
+            dlat = np.radians(lats - lat1)
+            dlon = np.radians(lons - lon1)
+            a = np.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * np.cos(np.radians(lats)) * np.sin(dlon/2)**2
+            a = np.clip(a, 0.0, 1.0)
+            c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+            distances = np.where(valid, np.maximum(R * c, 0.1), np.nan)
+        else:
+            valid = np.zeros(n, dtype=bool)
+            distances = np.full(n, np.nan)
+
+        # Text similarity fallback for the rows the vectorized path could not handle
+        for i in np.flatnonzero(~valid):
+            distances[i] = DistanceCalculator.calculate_distance(origin_addr, to_addr(records[i]))
+
+        return distances
+
 # ---------------- DOCTOR SORTER CLASS (USES DATA STRUCTURES) ----------------
-# Uses Heap data structure for efficient sorting by distance
+# Uses NumPy arrays for vectorized distance calculation and sorting
 class DoctorSorter:
     @staticmethod
-    def sort_doctors_by_distance(doctors, patient_address):
+    def _doctor_address(doctor):
+        """Address dict for a doctor row (Data Structure: Dictionary)"""
+        return {
+            'city': doctor['city'], 'state': doctor['state'],
+            'pincode': doctor['pincode'], 'address': doctor['full_address'],
+            'latitude': doctor['latitude'], 'longitude': doctor['longitude']
+        }
+
+    @staticmethod
+    def sort_doctors_by_distance(doctors, patient_address, top_k=None):
         """
-        Sort doctors by distance using min-heap (priority queue).
-        Data Structure: Heap for O(n log n) sorting with distance priority
+        Sort doctors by distance with a single vectorized pass.
+        When top_k is given only the nearest top_k doctors are selected (O(n)
+        argpartition) and sorted.
+        Data Structure: NumPy arrays, lexsort on (distance, doctor id) in O(n log n)
+        Rows are read in place; dicts are built only for the doctors returned.
         """
-        distance_heap = []
-        calculator = DistanceCalculator()
-
-        for doctor in doctors:
-            doctor_dict = dict(doctor)
-            doctor_addr = {
-                'city': doctor['city'], 'state': doctor['state'],
-                'pincode': doctor['pincode'], 'address': doctor['full_address'],
-                'latitude': doctor['latitude'], 'longitude': doctor['longitude']
-            }
+        distances = DistanceCalculator.calculate_distances(
+            patient_address, doctors, to_addr=DoctorSorter._doctor_address)
+        ids = np.fromiter((doctor['id'] for doctor in doctors), dtype=np.int64, count=len(doctors))
 
-            distance = calculator.calculate_distance(patient_address, doctor_addr)
-            doctor_dict['distance'] = distance
-            doctor_dict['distance_display'] = f"{distance:.1f} km" if distance != -1 else "N/A"
+        if top_k is not None and top_k < len(distances):
+            # Select the nearest top_k first, then sort only those
+            order = np.argpartition(distances, top_k - 1)[:top_k] if top_k > 0 else np.array([], dtype=np.intp)
+        else:
+            order = np.arange(len(distances))
 
-            # Push to heap: (priority, tie_breaker, data)
-            heapq.heappush(distance_heap, (doctor_dict['distance'], doctor_dict['id'], doctor_dict))
+        # Closest first, doctor id as tie-breaker
+        order = order[np.lexsort((ids[order], distances[order]))]
 
-        # Extract sorted list
         sorted_doctors = []
-        while distance_heap:
-            _, _, doctor_dict = heapq.heappop(distance_heap)
+        for i in order:
+            doctor_dict = dict(doctors[i])
+            distance = float(distances[i])
+            doctor_dict['distance'] = distance
+            doctor_dict['distance_display'] = f"{distance:.1f} km" if distance != -1 else "N/A"
             sorted_doctors.append(doctor_dict)
 
         return sorted_doctors
@@ -361,33 +777,156 @@ class NotificationManager:
         return self.db.execute_query(query, tuple(params), fetch_all=True)
 
 # ---------------- GLOBAL FLASK APP INSTANCE ----------------
+class RowJSONProvider(DefaultJSONProvider):
+    """JSON provider that serialises sqlite3.Row objects as they are written, so views can
+    return query results without converting every row to a dict first"""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, sqlite3.Row):
+            return dict(zip(o.keys(), o))
+        return DefaultJSONProvider.default(o)
+
 app = Flask(__name__)
+app.json = RowJSONProvider(app)
 app.secret_key = 'your-secret-key-here'  # Should be from config
 
+# Log records are queued by request threads and written by one background listener,
+# so an error path never blocks on the stream write. The listener has no request context,
+# so it writes to the process's stderr with Flask's log format rather than through
+# Flask's default handler (whose stream is the request's wsgi.errors).
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler(sys.stderr)
+_log_handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s in %(module)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler, respect_handler_level=True)
+app.logger.handlers = [logging.handlers.QueueHandler(_log_queue)]
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# Bring the database schema up to date once at startup
+DatabaseManager().ensure_schema()
+
 # ---------------- UTILITY FUNCTIONS ----------------
-def get_db():
-    """Get database connection"""
-    db_manager = DatabaseManager()
-    return db_manager.get_connection()
+def get_db(write=False):
+    """Get the request's pooled database connection (returned to the pool at teardown).
+    Views that write pass write=True to hold the writer lock for the request."""
+    conn = g.get("db")
+    if conn is not None and write and not conn.writer:
+        conn.close()  # trade the read connection for a writer one
+    if conn is None or conn.closed:
+        conn = g.db = DatabaseManager().get_connection(write=write)
+    return conn
+
+def fetch_dicts(conn, sql, params=()):
+    """Run a query and return plain dicts, zipping column names taken once from cursor.description"""
+    cur = conn.cursor()
+    cur.row_factory = None  # plain tuples; names are attached below
+    cur.execute(sql, params)
+    cols = tuple(c[0] for c in cur.description)
+    return [dict(zip(cols, row)) for row in cur]
+
+def current_doctor_id(conn):
+    """doctors.id of the logged-in doctor, looked up once per login and kept in the session"""
+    doctor_id = session.get("doctor_id")
+    if doctor_id is None:
+        row = conn.execute("SELECT id FROM doctors WHERE user_id=?", (session["user_id"],)).fetchone()
+        if row is not None:
+            doctor_id = session["doctor_id"] = row["id"]
+    return doctor_id
+
+@app.teardown_appcontext
+def release_db(exc):
+    """Hand the request's connection back to the pool"""
+    conn = g.pop("db", None)
+    if conn is not None:
+        conn.close()
 
+def begin_immediate(conn, attempts=3):
+    """Open a write transaction up front so SQLITE_BUSY surfaces here, not mid-update.
+    Each attempt already waits busy_timeout inside SQLite; retry a few times after that."""
+    for attempt in range(attempts):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            return conn
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.05 * (attempt + 1))
+
+@contextmanager
+def read_snapshot(conn):
+    """Run a group of SELECTs inside one read transaction (one shared lock, one snapshot)"""
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    finally:
+        conn.commit()
+
+# Every user has at most one wallet (wallets.user_id is UNIQUE); this creates it on first use
+_WALLET_ENSURE_SQL = "INSERT OR IGNORE INTO wallets (user_id, balance) VALUES (?, 0.0)"
+
+# Patient notification texts, filled in by SQLite's printf() as the row is inserted
+# (arguments: doctor name, appointment date, appointment time[, amount])
+_MSG_APPT_ACCEPTED = "Your appointment with Dr. %s on %s at %s has been accepted. ₹%s has been deducted from your wallet."
+_MSG_APPT_REJECTED = "Your appointment with Dr. %s on %s at %s has been rejected."
+_MSG_APPT_REJECTED_REFUND = "Your appointment with Dr. %s on %s at %s has been rejected. Rs %s has been refunded to your wallet."
+_MSG_APPT_CANCELLED = "Your appointment with Dr. %s on %s at %s has been cancelled. ₹%s has been refunded to your wallet."
+
+_NOTIFY_APPT_SQL = """
+    INSERT INTO notifications (user_id, message, type)
+    VALUES (?, printf(?, ?, ?, ?, ?), ?)
+"""
+
+def notify_appointment(conn, appointment, template, notif_type, amount=None):
+    """Insert a patient notification for an appointment row from one of the _MSG_APPT_* templates"""
+    conn.execute(_NOTIFY_APPT_SQL, (appointment['patient_id'], template, session.get('name'),
+                                    appointment['date'], appointment['time'], amount, notif_type))
+
+# Consultation fees per specialty, built once with interned keys
+# Keyed by lowercase name, matching the case-insensitive specialty search
+_SPECIALTY_FEES = {sys.intern(specialty.lower()): fees for specialty, fees in {
+    'General Physician': 200, 'Gynaecology': 500, 'Dermatology': 500,
+    'Gastrology': 200, 'Psychiatry': 200, 'Child Care': 500,
+    'Urology': 500, 'Cold & Fever': 500
+}.items()}
+
+@functools.lru_cache(maxsize=64)
 def get_specialty_fees(specialty):
-    """Get consultation fees based on specialty (Data Structure: Dictionary)"""
-    specialty_fees = {
-        'General Physician': 200, 'Gynaecology': 500, 'Dermatology': 500,
-        'Gastrology': 200, 'Psychiatry': 200, 'Child Care': 500,
-        'Urology': 500, 'Cold & Fever': 500
-    }
-    return specialty_fees.get(specialty, 0)
+    """Get consultation fees based on specialty (Data Structure: Dictionary, memoized per name)"""
+    if not specialty:
+        return 0
+    return _SPECIALTY_FEES.get(specialty.strip().lower(), 0)
+
+def _specialty_fees_sql(column):
+    """SQL CASE expression giving the same fee as get_specialty_fees for a specialty column"""
+    whens = " ".join("WHEN '{}' THEN {}".format(name.replace("'", "''"), fees)
+                     for name, fees in _SPECIALTY_FEES.items())
+    return f"CASE lower(trim({column})) {whens} ELSE 0 END"
 
 # ---------------- HOME ----------------
+@functools.cache
+def _rendered_page(template):
+    """Rendered bytes of a template that takes no context (Data Structure: Memo Cache)"""
+    return render_template(template).encode("utf-8")
+
+def _cached_page(template):
+    if app.debug:
+        _rendered_page.cache_clear()  # pick up template edits while developing
+    return Response(_rendered_page(template), mimetype="text/html")
+
 @app.route("/")
 def home():
-    return render_template("home.html")
+    return _cached_page("home.html")
 
 @app.route("/static-page")
 def static_page():
     """Standalone responsive static page."""
-    return render_template("static_page.html")
+    # base.html shows flashed messages, so only the flash-free render is cached
+    if "_flashes" in session:
+        return render_template("static_page.html")
+    return _cached_page("static_page.html")
 
 # ---------------- REGISTER ----------------
 @app.route("/register", methods=["GET", "POST"])
@@ -395,7 +934,7 @@ def register():
     if request.method == "POST":
         conn = None
         try:
-            conn = get_db()
+            conn = get_db(write=True)
 
             fname = request.form["fname"]
             mname = request.form.get("mname")
@@ -413,6 +952,9 @@ def register():
             patient_pincode = request.form.get("patient_pincode")
             patient_address = request.form.get("patient_address")
 
+            # Take the write lock up front so the user, wallet and doctor rows
+            # land in one transaction without a mid-flight lock upgrade
+            begin_immediate(conn)
             cur = conn.execute("""
                 INSERT INTO users
                 (fname, mname, lname, dob, age, email, password, role,
@@ -473,14 +1015,15 @@ def login():
             "SELECT * FROM users WHERE email=? AND password=?",
             (email, password)
         ).fetchone()
-        conn.close()
 
         if user:
             session["user_id"] = user["id"]
             session["role"] = user["role"]
             session["name"] = user["fname"]
+            session.pop("doctor_id", None)  # never carry over another account's doctor id
 
             if user["role"] == "doctor":
+                current_doctor_id(conn)
                 return redirect("/doctor/dashboard")
             else:
                 return redirect("/dashboard")
@@ -499,61 +1042,48 @@ def dashboard():
     conn = get_db()
 
     # Get current date and time for filtering
-    from datetime import datetime
-    now = datetime.now()
-    current_date = now.strftime('%Y-%m-%d')
-    current_datetime = now.strftime('%Y-%m-%d %H:%M:%S')
+    now, current_date, current_time, greeting = _now_context()
+    cutoff = f"{current_date} {current_time}"
 
-    # Get upcoming accepted appointments (future dates or today but future time)
-    upcoming_appointments = conn.execute("""
-        SELECT a.*, d.fname as doctor_fname, d.lname as doctor_lname, d.specialty
-        FROM appointments a
-        JOIN doctors d ON a.doctor_id = d.id
-        WHERE a.patient_id=? AND a.status='accepted' AND
-        (a.date > ? OR (a.date = ? AND a.time > ?))
-        ORDER BY a.date, a.time
-    """, (session["user_id"], current_date, current_date, now.strftime('%H:%M'))).fetchall()
-
-    # Get past appointments (past dates or today but past time)
-    past_appointments = conn.execute("""
-        SELECT a.*, d.fname as doctor_fname, d.lname as doctor_lname, d.specialty
-        FROM appointments a
-        JOIN doctors d ON a.doctor_id = d.id
-        WHERE a.patient_id=? AND
-        (a.date < ? OR (a.date = ? AND a.time <= ?))
-        ORDER BY a.date DESC, a.time DESC
-        LIMIT 5
-    """, (session["user_id"], current_date, current_date, now.strftime('%H:%M'))).fetchall()
+    # All dashboard reads share one read transaction
+    with read_snapshot(conn):
+        # Get upcoming accepted appointments (future dates or today but future time)
+        upcoming_appointments = conn.execute("""
+            SELECT a.*, d.fname as doctor_fname, d.lname as doctor_lname, d.specialty
+            FROM appointments a
+            JOIN doctors d ON a.doctor_id = d.id
+            WHERE a.patient_id=? AND a.status='accepted' AND a.dt > ?
+            ORDER BY a.dt
+        """, (session["user_id"], cutoff)).fetchall()
 
-    # Get patient notifications
-    notifications = conn.execute("""
-        SELECT * FROM notifications
-        WHERE user_id=? AND type IN ('appointment_accepted', 'appointment_rejected')
-        ORDER BY created_at DESC
-        LIMIT 5
-    """, (session["user_id"],)).fetchall()
+        # Get past appointments (past dates or today but past time)
+        past_appointments = conn.execute("""
+            SELECT a.*, d.fname as doctor_fname, d.lname as doctor_lname, d.specialty
+            FROM appointments a
+            JOIN doctors d ON a.doctor_id = d.id
+            WHERE a.patient_id=? AND a.dt <= ?
+            ORDER BY a.dt DESC
+            LIMIT 5
+        """, (session["user_id"], cutoff)).fetchall()
 
-    # Get user profile completeness
-    user = conn.execute("SELECT profile_percent FROM users WHERE id=?", (session["user_id"],)).fetchone()
-    profile_percent = user["profile_percent"] if user else 0
+        # Get patient notifications
+        notifications = conn.execute("""
+            SELECT * FROM notifications
+            WHERE user_id=? AND type IN ('appointment_accepted', 'appointment_rejected')
+            ORDER BY created_at DESC
+            LIMIT 5
+        """, (session["user_id"],)).fetchall()
 
-    # Unread notifications count for navbar badge
-    notifications_count = conn.execute(
-        "SELECT COUNT(*) as count FROM notifications WHERE user_id=? AND read=0",
-        (session["user_id"],)
-    ).fetchone()["count"]
+        # Get user profile completeness and unread notifications count (navbar badge) together
+        user = conn.execute("""
+            SELECT profile_percent, unread_notifications as unread_count
+            FROM users WHERE id=?
+        """, (session["user_id"],)).fetchone()
+        profile_percent = user["profile_percent"] if user else 0
+        notifications_count = user["unread_count"] if user else 0
 
     conn.close()
 
-    # Determine time-based greeting
-    current_hour = now.hour
-    if current_hour < 12:
-        greeting = "Good Morning"
-    elif current_hour < 17:
-        greeting = "Good Afternoon"
-    else:
-        greeting = "Good Evening"
-
     return render_template("dashboard.html",
                          name=session.get("name"),
                          greeting=greeting,
@@ -572,7 +1102,6 @@ def appointments():
     conn = get_db()
 
     # Get today's date
-    from datetime import datetime
     today = datetime.now().strftime('%Y-%m-%d')
 
     # Get today's appointments with complete doctor info
@@ -628,7 +1157,7 @@ def cancel_appointment(appointment_id):
     if "user_id" not in session or session.get("role") != "user":
         return redirect("/login")
 
-    conn = get_db()
+    conn = get_db(write=True)
     
     try:
         # Verify the appointment belongs to the current user
@@ -678,7 +1207,7 @@ def cancel_appointment(appointment_id):
         
     except Exception as e:
         conn.rollback()
-        print(f"Error cancelling appointment: {e}")
+        app.logger.exception("Error cancelling appointment")
         return {"error": str(e)}, 500
     finally:
         conn.close()
@@ -690,55 +1219,53 @@ def doctor_dashboard():
         return redirect("/login")
 
     conn = get_db()
-    doctor = conn.execute("""
-        SELECT profile_complete, profile_percent
-        FROM doctors WHERE user_id=?
-    """, (session["user_id"],)).fetchone()
-
-    if not doctor:
-        # If doctor profile not found, create default values
-        profile_complete = 0
-        profile_percent = 25
-    else:
-        profile_complete = doctor["profile_complete"]
-        profile_percent = doctor["profile_percent"]
-
-    # Get doctor's ID
-    doctor_id = conn.execute("SELECT id FROM doctors WHERE user_id=?", (session["user_id"],)).fetchone()["id"]
 
     # Get today's date
-    from datetime import datetime
     today = datetime.now().strftime('%Y-%m-%d')
 
-    # Get today's appointments list
-    todays_appointments = conn.execute("""
-        SELECT a.*, u.fname as patient_fname, u.lname as patient_lname
-        FROM appointments a
-        JOIN users u ON a.patient_id = u.id
-        WHERE a.doctor_id=? AND a.date=? AND a.status='accepted'
-        ORDER BY a.time
-    """, (doctor_id, today)).fetchall()
-
-    # Get upcoming appointments (future dates)
-    upcoming_appointments = conn.execute("""
-        SELECT a.*, u.fname as patient_fname, u.lname as patient_lname
-        FROM appointments a
-        JOIN users u ON a.patient_id = u.id
-        WHERE a.doctor_id=? AND a.date > ? AND a.status='accepted'
-        ORDER BY a.date, a.time
-    """, (doctor_id, today)).fetchall()
+    # All dashboard reads share one read transaction
+    with read_snapshot(conn):
+        # Get doctor's ID and profile completeness in one lookup
+        doctor = conn.execute("""
+            SELECT id, profile_complete, profile_percent
+            FROM doctors WHERE user_id=?
+        """, (session["user_id"],)).fetchone()
+
+        if not doctor:
+            # If doctor profile not found, create default values
+            doctor_id = None
+            profile_complete = 0
+            profile_percent = 25
+        else:
+            doctor_id = doctor["id"]
+            profile_complete = doctor["profile_complete"]
+            profile_percent = doctor["profile_percent"]
 
-    # Get total patients count
-    total_patients = conn.execute("""
-        SELECT COUNT(DISTINCT patient_id) as count FROM appointments
-        WHERE doctor_id=? AND status='accepted'
-    """, (doctor_id,)).fetchone()["count"]
+        # Get today's and upcoming appointments in one pass, split by date below
+        accepted_appointments = conn.execute("""
+            SELECT a.*, u.fname as patient_fname, u.lname as patient_lname
+            FROM appointments a
+            JOIN users u ON a.patient_id = u.id
+            WHERE a.doctor_id=? AND a.date >= ? AND a.status='accepted'
+            ORDER BY a.date, a.time
+        """, (doctor_id, today)).fetchall()
 
-    # Get unread notifications count
-    notifications_count = conn.execute("SELECT COUNT(*) as count FROM notifications WHERE user_id=? AND read=0", (session["user_id"],)).fetchone()["count"]
+        # Get total patients and unread notifications counts (both trigger-maintained) in one query
+        counts = conn.execute("""
+            SELECT
+                COALESCE((SELECT patients FROM doctor_patient_counts
+                          WHERE doctor_id=?), 0) as total_patients,
+                COALESCE((SELECT unread_notifications FROM users
+                          WHERE id=?), 0) as unread_count
+        """, (doctor_id, session["user_id"])).fetchone()
+        total_patients = counts["total_patients"]
+        notifications_count = counts["unread_count"]
 
     conn.close()
 
+    todays_appointments = [a for a in accepted_appointments if a["date"] == today]
+    upcoming_appointments = [a for a in accepted_appointments if a["date"] > today]
+
     return render_template(
         "doctor_dashboard.html",
         name=session.get("name"),
@@ -752,6 +1279,20 @@ def doctor_dashboard():
     )
 
 # ---------------- DOCTOR APPOINTMENTS ----------------
+_DOCTOR_APPOINTMENTS_SQL = """
+        SELECT a.*, u.fname as patient_fname, u.lname as patient_lname,
+               strftime('%Y-%m-%d', a.date) as date_str,
+               -- 'DD Mon YYYY' (SQLite's strftime has no %b, so the month name is sliced out)
+               strftime('%d', a.date) || ' ' ||
+               substr('JanFebMarAprMayJunJulAugSepOctNovDec', strftime('%m', a.date) * 3 - 2, 3) || ' ' ||
+               strftime('%Y', a.date) as date_display
+        FROM appointments a
+        JOIN users u ON a.patient_id = u.id
+        JOIN doctors d ON a.doctor_id = d.id
+        WHERE d.user_id=? AND a.status IN ('accepted', 'pending')
+        ORDER BY a.date, a.time
+    """
+
 @app.route("/doctor/appointments")
 def doctor_appointments():
     if "user_id" not in session or session.get("role") != "doctor":
@@ -759,47 +1300,32 @@ def doctor_appointments():
 
     conn = get_db()
 
-    # Get doctor's ID
-    doctor_id = conn.execute("SELECT id FROM doctors WHERE user_id=?", (session["user_id"],)).fetchone()["id"]
-
     # Get today's date
-    from datetime import datetime
-    today = datetime.now().strftime('%Y-%m-%d')
-    today_obj = datetime.strptime(today, '%Y-%m-%d')
+    today_obj = date.today()
+    today = today_obj.isoformat()
     today_display = today_obj.strftime('%d %b %Y')
 
     # Get all accepted and pending appointments grouped by date
-    appointments_by_date = conn.execute("""
-        SELECT a.*, u.fname as patient_fname, u.lname as patient_lname,
-               strftime('%Y-%m-%d', a.date) as date_str
-        FROM appointments a
-        JOIN users u ON a.patient_id = u.id
-        WHERE a.doctor_id=? AND a.status IN ('accepted', 'pending')
-        ORDER BY a.date, a.time
-    """, (doctor_id,)).fetchall()
+    # (doctor's ID is resolved inside the same query)
+    appointments_by_date = conn.execute(_DOCTOR_APPOINTMENTS_SQL, (session["user_id"],)).fetchall()
 
-    # Debug: Print today's date and appointment dates
-    print(f"DEBUG: Today's date: {today}")
-    for apt in appointments_by_date:
-        print(f"DEBUG: Appointment date: {apt['date_str']}, Original date: {apt['date']}")
+    # Debug: Log today's date and appointment dates (skipped entirely unless debug logging is on)
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug("Today's date: %s", today)
+        for apt in appointments_by_date:
+            app.logger.debug("Appointment date: %s, Original date: %s", apt['date_str'], apt['date'])
 
     # Build grouped_appointments
     grouped_appointments = {}
 
     for appointment in appointments_by_date:
-        date = appointment['date_str']
-        # Format date for display
-        try:
-            date_obj = datetime.strptime(date, '%Y-%m-%d')
-            formatted_date = date_obj.strftime('%d %b %Y')
-        except:
-            formatted_date = date
+        date_str = appointment['date_str']
+        # Display date computed in SQL (NULL only when the stored date is unparseable)
+        formatted_date = appointment['date_display'] or date_str
 
         if formatted_date not in grouped_appointments:
-            grouped_appointments[formatted_date] = {'date_key': date, 'appointments': []}
-        grouped_appointments[formatted_date]['appointments'].append(dict(appointment))
-
-    conn.close()
+            grouped_appointments[formatted_date] = {'date_key': date_str, 'appointments': []}
+        grouped_appointments[formatted_date]['appointments'].append(appointment)
 
     return render_template(
         "doctor_appointments.html",
@@ -810,19 +1336,27 @@ def doctor_appointments():
     )
 
 # ---------------- DOCTOR PROFILE (COMPLETE PROFILE PAGE) ----------------
+# Profile completion weight of each optional form field (Data Structure: Tuple of pairs)
+_DOCTOR_PROFILE_WEIGHTS = (
+    ('specialty', 7), ('age', 3), ('experience_years', 3), ('qualification', 7),
+    ('license', 7), ('hospital_name', 4), ('city', 4), ('state', 4), ('landmark', 3),
+    ('full_address', 7), ('pincode', 4), ('latitude', 3), ('longitude', 3),
+    ('staff_count', 3), ('languages', 3), ('reviews', 6), ('awards', 6),
+    ('emergency_contact', 5),
+)
+
 @app.route("/doctor/profile", methods=["GET", "POST"])
 def doctor_profile():
     if 'user_id' not in session or session.get('role') != 'doctor':
         return redirect("/login")
 
-    conn = get_db()
+    conn = get_db(write=request.method == "POST")
     doctor = conn.execute(
         "SELECT * FROM doctors WHERE user_id = ?",
         (session["user_id"],)
     ).fetchone()
 
     if not doctor:
-        conn.close()
         flash("Doctor profile not found", "danger")
         return redirect("/doctor/dashboard")
 
@@ -848,27 +1382,9 @@ def doctor_profile():
         emergency_contact = request.form.get("emergency_contact")
 
         # Calculate profile completion percentage
-        percent = 25  # Base percentage
-        if specialty: percent += 7  # Specialty is required
-        # Fees are now auto-calculated, so always count as complete
-        percent += 7  # Fees is required (auto-calculated)
-        if age: percent += 3
-        if experience_years: percent += 3
-        if qualification: percent += 7
-        if license_no: percent += 7
-        if hospital_name: percent += 4
-        if city: percent += 4
-        if state: percent += 4
-        if landmark: percent += 3
-        if full_address: percent += 7
-        if pincode: percent += 4
-        if latitude: percent += 3
-        if longitude: percent += 3
-        if staff_count: percent += 3
-        if languages: percent += 3
-        if reviews: percent += 6
-        if awards: percent += 6
-        if emergency_contact: percent += 5
+        # 25 base + 7 for fees (auto-calculated, so always counted) + each filled field's weight
+        form = request.form
+        percent = 25 + 7 + sum(weight for field, weight in _DOCTOR_PROFILE_WEIGHTS if form.get(field))
 
         profile_complete = 1 if percent >= 100 else 0
 
@@ -892,11 +1408,9 @@ def doctor_profile():
             session["user_id"]
         ))
         conn.commit()
-        conn.close()
         flash("Profile updated successfully", "success")
         return redirect("/doctor/dashboard")
 
-    conn.close()
     return render_template(
         "doctor_complete_profile.html",
         doctor=doctor,
@@ -911,7 +1425,6 @@ def patient_profile():
 
     conn = get_db()
     user = conn.execute("SELECT * FROM users WHERE id=?", (session["user_id"],)).fetchone()
-    conn.close()
 
     if not user:
         flash("User profile not found", "danger")
@@ -925,7 +1438,7 @@ def edit_patient_profile():
     if "user_id" not in session or session.get("role") != "user":
         return redirect("/login")
 
-    conn = get_db()
+    conn = get_db(write=request.method == "POST")
     user = conn.execute("SELECT * FROM users WHERE id=?", (session["user_id"],)).fetchone()
 
     if request.method == "POST":
@@ -960,15 +1473,23 @@ def edit_patient_profile():
         ))
 
         conn.commit()
-        conn.close()
 
         flash("Profile updated successfully!", "success")
         return redirect("/profile")
 
-    conn.close()
     return render_template("edit_patient_profile.html", user=user)
 
 # ---------------- PATIENT APPOINTMENT HISTORY ----------------
+_PATIENT_HISTORY_SQL = """
+        SELECT a.*, d.fname as doctor_fname, d.lname as doctor_lname, d.specialty,
+               d.qualification, d.hospital_name, d.city, d.state, p.amount, p.payment_method, p.status as payment_status
+        FROM appointments a
+        JOIN doctors d ON a.doctor_id = d.id
+        LEFT JOIN payments p ON a.id = p.appointment_id
+        WHERE a.patient_id=?
+        ORDER BY d.fname, d.lname, a.date DESC, a.time DESC
+    """
+
 @app.route("/history")
 def appointment_history():
     if "user_id" not in session or session.get("role") != "user":
@@ -977,36 +1498,31 @@ def appointment_history():
     conn = get_db()
 
     # Get all appointments for the patient with doctor details
-    appointments = conn.execute("""
-        SELECT a.*, d.fname as doctor_fname, d.lname as doctor_lname, d.specialty,
-               d.qualification, d.hospital_name, d.city, d.state, p.amount, p.payment_method, p.status as payment_status
-        FROM appointments a
-        JOIN doctors d ON a.doctor_id = d.id
-        LEFT JOIN payments p ON a.id = p.appointment_id
-        WHERE a.patient_id=?
-        ORDER BY d.fname, d.lname, a.date DESC, a.time DESC
-    """, (session["user_id"],)).fetchall()
+    appointments = conn.execute(_PATIENT_HISTORY_SQL, (session["user_id"],)).fetchall()
 
-    # Group appointments by doctor
+    # Group appointments by doctor (rows arrive ordered by doctor name, so each doctor is one run)
     doctors_appointments = {}
-    for appointment in appointments:
-        doctor_key = f"{appointment['doctor_fname']} {appointment['doctor_lname']}"
-        if doctor_key not in doctors_appointments:
-            doctors_appointments[doctor_key] = {
+    rows_by_doctor = itertools.groupby(
+        appointments, key=lambda row: f"{row['doctor_fname']} {row['doctor_lname']}")
+    for doctor_key, rows in rows_by_doctor:
+        first = next(rows)
+        # Already present only when a different name pair joins to the same text
+        entry = doctors_appointments.get(doctor_key)
+        if entry is None:
+            entry = doctors_appointments[doctor_key] = {
                 'doctor_info': {
-                    'fname': appointment['doctor_fname'],
-                    'lname': appointment['doctor_lname'],
-                    'specialty': appointment['specialty'],
-                    'qualification': appointment['qualification'],
-                    'hospital_name': appointment['hospital_name'],
-                    'city': appointment['city'],
-                    'state': appointment['state']
+                    'fname': first['doctor_fname'],
+                    'lname': first['doctor_lname'],
+                    'specialty': first['specialty'],
+                    'qualification': first['qualification'],
+                    'hospital_name': first['hospital_name'],
+                    'city': first['city'],
+                    'state': first['state']
                 },
                 'appointments': []
             }
-        doctors_appointments[doctor_key]['appointments'].append(dict(appointment))
-
-    conn.close()
+        entry['appointments'].append(first)
+        entry['appointments'].extend(rows)
 
     return render_template("history.html", doctors_appointments=doctors_appointments)
 
@@ -1029,67 +1545,85 @@ def forgot_password():
 
     return render_template('forgot_password.html')
 # ---------------- PUBLIC DOCTOR PROFILE ----------------
+_DOCTOR_PROFILE_PUBLIC_SQL = """
+        SELECT d.id, d.fname, d.lname, d.specialty, {fees} as fees, d.rating, d.age, d.qualification, d.license,
+               d.hospital_name, d.staff_count, d.experience_years, d.reviews, d.awards, d.languages,
+               d.emergency_contact, d.hospital_timing, d.hospital_contact,
+               d.city, d.state, d.pincode, d.full_address, d.latitude, d.longitude,
+               u.id as p_id, u.patient_address as p_address, u.patient_city as p_city,
+               u.patient_state as p_state, u.patient_pincode as p_pincode,
+               u.patient_latitude as p_latitude, u.patient_longitude as p_longitude
+        FROM doctors d
+        LEFT JOIN users u ON u.id=?
+        WHERE d.id=? AND d.profile_complete=1
+""".format(fees=_specialty_fees_sql("d.specialty"))
+
 @app.route("/doctor/<int:doctor_id>")
 def doctor_profile_public(doctor_id):
     conn = get_db()
-    doctor = conn.execute("""
-        SELECT * FROM doctors
-        WHERE id=? AND profile_complete=1
-    """, (doctor_id,)).fetchone()
+    # Doctor plus the logged-in patient's address in one query (p_* columns are NULL otherwise)
+    patient_user_id = session["user_id"] if "user_id" in session and session.get("role") == "user" else None
+    doctor = conn.execute(_DOCTOR_PROFILE_PUBLIC_SQL, (patient_user_id, doctor_id)).fetchone()
 
     # Get patient address and calculate distance if logged in
     patient_address = ""
     distance = None
-    if "user_id" in session and session.get("role") == "user":
-        patient = conn.execute("SELECT * FROM users WHERE id=?", (session["user_id"],)).fetchone()
-        if patient:
-            # Build full address from patient profile
-            address_parts = []
-            if patient['patient_address']:
-                address_parts.append(patient['patient_address'])
-            if patient['patient_city']:
-                address_parts.append(patient['patient_city'])
-            if patient['patient_state']:
-                address_parts.append(patient['patient_state'])
-            if patient['patient_pincode']:
-                address_parts.append(patient['patient_pincode'])
-            patient_address = ", ".join(address_parts)
-
-            # Calculate distance from patient to doctor's hospital
-            if doctor:
-                doctor_addr = {
-                    'city': doctor['city'],
-                    'state': doctor['state'],
-                    'pincode': doctor['pincode'],
-                    'address': doctor['full_address'],
-                    'latitude': doctor['latitude'],
-                    'longitude': doctor['longitude']
-                }
-
-                patient_addr = {
-                    'city': patient['patient_city'],
-                    'state': patient['patient_state'],
-                    'pincode': patient['patient_pincode'],
-                    'address': patient['patient_address'],
-                    'latitude': patient['patient_latitude'],
-                    'longitude': patient['patient_longitude']
-                }
-
-                calculated_distance = DistanceCalculator.calculate_distance(patient_addr, doctor_addr)
-                distance = f"{calculated_distance:.1f} km" if calculated_distance != -1 else "N/A"
+    if doctor and doctor['p_id'] is not None:
+        # Build full address from patient profile
+        address_parts = []
+        if doctor['p_address']:
+            address_parts.append(doctor['p_address'])
+        if doctor['p_city']:
+            address_parts.append(doctor['p_city'])
+        if doctor['p_state']:
+            address_parts.append(doctor['p_state'])
+        if doctor['p_pincode']:
+            address_parts.append(doctor['p_pincode'])
+        patient_address = ", ".join(address_parts)
 
-    if not doctor:
-        conn.close()
-        return "Doctor profile incomplete or not found", 404
+        # Calculate distance from patient to doctor's hospital
+        doctor_addr = {
+            'city': doctor['city'],
+            'state': doctor['state'],
+            'pincode': doctor['pincode'],
+            'address': doctor['full_address'],
+            'latitude': doctor['latitude'],
+            'longitude': doctor['longitude']
+        }
 
-    doctor = dict(doctor)
-    doctor["fees"] = get_specialty_fees(doctor["specialty"])
+        patient_addr = {
+            'city': doctor['p_city'],
+            'state': doctor['p_state'],
+            'pincode': doctor['p_pincode'],
+            'address': doctor['p_address'],
+            'latitude': doctor['p_latitude'],
+            'longitude': doctor['p_longitude']
+        }
 
-    conn.close()
+        calculated_distance = DistanceCalculator.calculate_distance(patient_addr, doctor_addr)
+        distance = f"{calculated_distance:.1f} km" if calculated_distance != -1 else "N/A"
+
+    if not doctor:
+        return "Doctor profile incomplete or not found", 404
 
     return render_template("doctor_profile.html", doctor=doctor, patient_address=patient_address, distance=distance)
 
 # ---------------- BOOK SLOTS ----------------
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+_BOOK_SLOTS_DOCTOR_SQL = "SELECT id, fname, lname, specialty, {} as fees FROM doctors WHERE id=?".format(
+    _specialty_fees_sql("specialty"))
+
+@functools.lru_cache(maxsize=1)
+def _week_dates(today_ordinal):
+    """Bookable dates for the 7 days starting today, rebuilt once per calendar day"""
+    dates = []
+    for i in range(7):
+        date_obj = datetime.fromordinal(today_ordinal + i)
+        dates.append({'date': date_obj.strftime('%Y-%m-%d'),
+                      'display': f"{date_obj.day:02d} {_MONTHS[date_obj.month - 1]}"})
+    return tuple(dates)
+
 @app.route("/book_slots/<int:doctor_id>")
 def book_slots(doctor_id):
     if "user_id" not in session or session.get("role") != "user":
@@ -1099,15 +1633,11 @@ def book_slots(doctor_id):
 
 
 
-    doctor = conn.execute("SELECT * FROM doctors WHERE id=?", (doctor_id,)).fetchone()
+    doctor = conn.execute(_BOOK_SLOTS_DOCTOR_SQL, (doctor_id,)).fetchone()
 
     if not doctor:
-        conn.close()
         return "Doctor not found", 404
 
-    doctor = dict(doctor)
-    doctor["fees"] = get_specialty_fees(doctor["specialty"])
-
     # Get wallet balance
     wallet = conn.execute("SELECT balance FROM wallets WHERE user_id=?", (session["user_id"],)).fetchone()
     balance = wallet["balance"] if wallet else 0.0
@@ -1119,28 +1649,27 @@ def book_slots(doctor_id):
     """, (doctor_id,)).fetchall()
 
     # Group booked slots by date
-    booked_slots_dict = {}
+    booked_slots_dict = collections.defaultdict(list)
     for slot in booked_slots:
-        date = slot['date']
-        time = slot['time']
-        if date not in booked_slots_dict:
-            booked_slots_dict[date] = []
-        booked_slots_dict[date].append(time)
-
-    conn.close()
+        booked_slots_dict[slot['date']].append(slot['time'])
+    booked_slots_dict = dict(booked_slots_dict)
 
-    dates = []
-    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-    now = datetime.now()
-    for i in range(7):
-        date_obj = now + timedelta(days=i)
-        date_str = date_obj.strftime('%Y-%m-%d')
-        day = date_obj.strftime('%d')
-        month = months[date_obj.month - 1]
-        dates.append({'date': date_str, 'display': f"{day} {month}"})
+    dates = _week_dates(datetime.now().toordinal())
     return render_template("book_slots.html", doctor=doctor, dates=dates, balance=balance, booked_slots=booked_slots_dict)
 
 # ---------------- DOCTOR LIST (CONSULT NOW) ----------------
+# Columns the doctor cards and the distance sort read
+_DOCTOR_LIST_SQL = """
+        SELECT id, fname, lname, specialty, rating, qualification, experience_years,
+               city, state, pincode, full_address, latitude, longitude
+        FROM doctors
+"""
+_DOCTORS_BY_SPECIALTY_SQL = _DOCTOR_LIST_SQL + """        WHERE specialty = ? COLLATE NOCASE
+        AND profile_complete=1
+"""
+_ALL_DOCTORS_SQL = _DOCTOR_LIST_SQL + """        WHERE profile_complete=1
+"""
+
 @app.route("/doctors/<specialty>")
 def doctors_by_specialty(specialty):
     if "user_id" not in session or session.get("role") != "user":
@@ -1151,21 +1680,16 @@ def doctors_by_specialty(specialty):
     # Check patient profile completeness
     user = conn.execute("SELECT profile_percent FROM users WHERE id=?", (session["user_id"],)).fetchone()
     if not user or user["profile_percent"] < 100:
-        conn.close()
         flash("Please complete your profile (city, state, pincode, and address) before consulting a doctor.", "warning")
         return redirect("/profile/edit")
 
     # Get all doctors of the specialty
-    doctors = conn.execute("""
-        SELECT * FROM doctors
-        WHERE LOWER(specialty)=LOWER(?)
-        AND profile_complete=1
-    """, (specialty,)).fetchall()
+    doctors = conn.execute(_DOCTORS_BY_SPECIALTY_SQL, (specialty,)).fetchall()
 
     # Get patient address for sorting and distance calculation
     patient_address = None
     if "user_id" in session and session.get("role") == "user":
-        patient = conn.execute("SELECT * FROM users WHERE id=?", (session["user_id"],)).fetchone()
+        patient = conn.execute("SELECT patient_address, patient_city, patient_state, patient_pincode, patient_latitude, patient_longitude FROM users WHERE id=?", (session["user_id"],)).fetchone()
         if patient:
             patient_address = {
                 'city': patient['patient_city'],
@@ -1176,36 +1700,12 @@ def doctors_by_specialty(specialty):
                 'longitude': patient['patient_longitude']
             }
 
-    # Sort doctors by distance using priority queue (min-heap for closest distance first)
-    distance_heap = []
-    for doctor in doctors:
-        doctor_dict = dict(doctor)
-        # Calculate distance if patient address available
-        if patient_address:
-            doctor_addr = {
-                'city': doctor['city'],
-                'state': doctor['state'],
-                'pincode': doctor['pincode'],
-                'address': doctor['full_address'],
-                'latitude': doctor['latitude'],
-                'longitude': doctor['longitude']
-            }
-            distance = DistanceCalculator.calculate_distance(patient_address, doctor_addr)
-            doctor_dict['distance'] = distance
-            doctor_dict['distance_display'] = f"{distance:.1f} km" if distance != -1 else "N/A"
-        else:
-            doctor_dict['distance'] = 999
-            doctor_dict['distance_display'] = "N/A"
-        # Push to heap with distance as priority (min-heap for closest first), using doctor id as tie-breaker
-        heapq.heappush(distance_heap, (doctor_dict['distance'], doctor_dict['id'], doctor_dict))
-
-    # Extract from heap to get sorted list (closest distance first)
-    doctors_with_distance = []
-    while distance_heap:
-        _, _, doctor_dict = heapq.heappop(distance_heap)
-        doctors_with_distance.append(doctor_dict)
-
-    conn.close()
+    # Attach distances and sort doctors by distance (vectorized over all doctors at once)
+    if patient_address:
+        doctors_with_distance = DoctorSorter.sort_doctors_by_distance(doctors, patient_address)
+    else:
+        doctors_with_distance = [dict(doctor, distance=999, distance_display="N/A") for doctor in doctors]
+        doctors_with_distance.sort(key=operator.itemgetter('distance', 'id'))
 
     return render_template(
         "doctor_list.html",
@@ -1222,14 +1722,11 @@ def all_doctors():
     conn = get_db()
 
     # Get all doctors
-    doctors = conn.execute("""
-        SELECT * FROM doctors
-        WHERE profile_complete=1
-    """).fetchall()
+    doctors = conn.execute(_ALL_DOCTORS_SQL).fetchall()
 
     # Get patient address for sorting and distance calculation
     patient_address = None
-    patient = conn.execute("SELECT * FROM users WHERE id=?", (session["user_id"],)).fetchone()
+    patient = conn.execute("SELECT patient_address, patient_city, patient_state, patient_pincode, patient_latitude, patient_longitude FROM users WHERE id=?", (session["user_id"],)).fetchone()
     if patient:
         patient_address = {
             'city': patient['patient_city'],
@@ -1240,36 +1737,12 @@ def all_doctors():
             'longitude': patient['patient_longitude']
         }
 
-    # Sort doctors by distance using priority queue (min-heap for closest distance first)
-    distance_heap = []
-    for doctor in doctors:
-        doctor_dict = dict(doctor)
-        # Calculate distance if patient address available
-        if patient_address:
-            doctor_addr = {
-                'city': doctor['city'],
-                'state': doctor['state'],
-                'pincode': doctor['pincode'],
-                'address': doctor['full_address'],
-                'latitude': doctor['latitude'],
-                'longitude': doctor['longitude']
-            }
-            distance = DistanceCalculator.calculate_distance(patient_address, doctor_addr)
-            doctor_dict['distance'] = distance
-            doctor_dict['distance_display'] = f"{distance:.1f} km" if distance != -1 else "N/A"
-        else:
-            doctor_dict['distance'] = 999
-            doctor_dict['distance_display'] = "N/A"
-        # Push to heap with distance as priority (min-heap for closest first), using doctor id as tie-breaker
-        heapq.heappush(distance_heap, (doctor_dict['distance'], doctor_dict['id'], doctor_dict))
-
-    # Extract from heap to get sorted list (closest distance first)
-    doctors_with_distance = []
-    while distance_heap:
-        _, _, doctor_dict = heapq.heappop(distance_heap)
-        doctors_with_distance.append(doctor_dict)
-
-    conn.close()
+    # Attach distances and sort doctors by distance (vectorized over all doctors at once)
+    if patient_address:
+        doctors_with_distance = DoctorSorter.sort_doctors_by_distance(doctors, patient_address)
+    else:
+        doctors_with_distance = [dict(doctor, distance=999, distance_display="N/A") for doctor in doctors]
+        doctors_with_distance.sort(key=operator.itemgetter('distance', 'id'))
 
     return render_template(
         "doctor_list.html",
@@ -1284,12 +1757,20 @@ def doctor_notifications():
         return redirect("/login")
 
     conn = get_db()
-    # Mark doctor's notifications as seen when page is opened
-    conn.execute("""
-        UPDATE notifications
-        SET read=1
-        WHERE user_id=? AND type='appointment_request' AND read=0
-    """, (session["user_id"],))
+    # Mark doctor's notifications as seen when page is opened; the writer is only taken
+    # when there is an unread request to mark, and then covers the SELECT below too
+    has_unread = conn.execute("""
+        SELECT 1 FROM notifications
+        WHERE user_id=? AND read=0 AND type='appointment_request'
+        LIMIT 1
+    """, (session["user_id"],)).fetchone()
+    if has_unread:
+        conn = begin_immediate(get_db(write=True))
+        conn.execute("""
+            UPDATE notifications
+            SET read=1
+            WHERE user_id=? AND type='appointment_request' AND read=0
+        """, (session["user_id"],))
 
     notifications = conn.execute("""
         SELECT n.*, a.id as appointment_id, a.patient_id, a.doctor_id, a.date, a.time, a.address, a.status
@@ -1302,8 +1783,7 @@ def doctor_notifications():
     conn.close()
 
     # Get today's date for date input validation
-    from datetime import datetime
-    today = datetime.now().strftime('%Y-%m-%d')
+    today = date.today().isoformat()
 
     return render_template("notifications.html", notifications=notifications, today=today)
 
@@ -1378,7 +1858,6 @@ def payment():
     conn = get_db()
     doctor = conn.execute("SELECT * FROM doctors WHERE id=?", (doctor_id,)).fetchone()
     wallet = conn.execute("SELECT balance FROM wallets WHERE user_id=?", (session["user_id"],)).fetchone()
-    conn.close()
 
     if not doctor:
         flash("Doctor not found.", "danger")
@@ -1410,6 +1889,19 @@ def payment():
     return render_template("payment.html", doctor=doctor, selected_slots=selected_slots, wallet_balance=wallet_balance, total_fees=total_fees, back_url=back_url)
 
 # ---------------- CONFIRM PAYMENT ----------------
+# 'YYYY-MM-DD HH:MM' slot, with the 1-2 digit fields strptime would also take
+_SLOT_RE = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})\s+(\d{1,2}):(\d{1,2})", re.ASCII)
+
+def _parse_slot(date_str, time_str):
+    """Parse a booking slot without strptime; None when the date/time is invalid"""
+    match = _SLOT_RE.fullmatch(f"{date_str} {time_str}")
+    if match is None:
+        return None
+    try:
+        return datetime(*map(int, match.groups()))
+    except ValueError:
+        return None
+
 @app.route("/confirm_payment", methods=["POST"])
 def confirm_payment():
     if "user_id" not in session or session.get("role") != "user":
@@ -1419,12 +1911,11 @@ def confirm_payment():
     slot_count = int(request.form.get("slot_count", 1))
     payment_method = request.form["payment_method"]
 
-    conn = get_db()
+    conn = get_db(write=True)
 
     # Get doctor specialty to calculate category-based fees
     doctor = conn.execute("SELECT specialty FROM doctors WHERE id=?", (doctor_id,)).fetchone()
     if not doctor:
-        conn.close()
         flash("Doctor not found.", "danger")
         return redirect("/dashboard")
 
@@ -1440,7 +1931,6 @@ def confirm_payment():
             slots.append({"date": date, "time": time})
 
     if not slots:
-        conn.close()
         flash("No slots selected.", "danger")
         return redirect(f"/book_slots/{doctor_id}")
 
@@ -1457,38 +1947,39 @@ def confirm_payment():
     # --- Server-side validation: prevent double-booking ---
     now = datetime.now()
 
+    # Take the write lock before the conflict check so no other booking can
+    # claim these slots between the check and the inserts below
+    begin_immediate(conn)
+
+    # Fetch every already-taken (accepted or pending) slot among the requested ones in one query
+    slot_values = ",".join(["(?,?)"] * len(slots))
+    taken_slots = {(row['date'], row['time']) for row in conn.execute(f"""
+        SELECT date, time FROM appointments
+        WHERE doctor_id=? AND status IN ('accepted','pending')
+        AND (date, time) IN (VALUES {slot_values})
+    """, [doctor_id, *(value for slot in slots for value in (slot['date'], slot['time']))])}
+
     for slot in slots:
-        try:
-            appt_dt = datetime.strptime(f"{slot['date']} {slot['time']}", "%Y-%m-%d %H:%M")
-        except Exception:
-            conn.close()
+        appt_dt = _parse_slot(slot['date'], slot['time'])
+        if appt_dt is None:
             flash("Invalid date/time format.", "danger")
             return redirect(f"/book_slots/{doctor_id}")
 
         # Prevent booking slots in the past
         if appt_dt <= now:
-            conn.close()
             flash("Cannot book slots in the past.", "danger")
             return redirect(f"/book_slots/{doctor_id}")
 
         # Check if slot already taken (accepted or pending) - prevent double booking
-        existing = conn.execute("""
-            SELECT COUNT(*) as cnt FROM appointments
-            WHERE doctor_id=? AND date=? AND time=? AND status IN ('accepted','pending')
-        """, (doctor_id, slot['date'], slot['time'])).fetchone()
-        if existing and existing["cnt"] > 0:
-            conn.close()
+        if (slot['date'], slot['time']) in taken_slots:
             flash("This slot is already booked. Please choose different slots.", "danger")
             return redirect(f"/book_slots/{doctor_id}")
 
     # Check wallet balance if paying with wallet
     if payment_method == "wallet":
+        # Create wallet if it doesn't exist (no-op on the user_id UNIQUE constraint otherwise)
+        conn.execute(_WALLET_ENSURE_SQL, (session["user_id"],))
         wallet = conn.execute("SELECT balance FROM wallets WHERE user_id=?", (session["user_id"],)).fetchone()
-        if not wallet:
-            # Create wallet if it doesn't exist
-            conn.execute("INSERT INTO wallets (user_id, balance) VALUES (?, 0.0)", (session["user_id"],))
-            conn.commit()
-            wallet = conn.execute("SELECT balance FROM wallets WHERE user_id=?", (session["user_id"],)).fetchone()
         if wallet["balance"] < total_fees:
             # Store payment data in session for when user returns from wallet
             session['payment_data'] = {
@@ -1497,44 +1988,42 @@ def confirm_payment():
                 'slots': slots,
                 'payment_method': payment_method
             }
-            conn.close()
             session['return_url'] = '/payment'
             session['wallet_back_url'] = '/payment'
+            conn.commit()  # keep a newly created wallet
             flash("Insufficient wallet balance. Please add money to your wallet or choose another payment method.", "danger")
             return redirect("/wallet")
 
         # Deduct from wallet
         conn.execute("UPDATE wallets SET balance = balance - ? WHERE user_id=?", (total_fees, session["user_id"]))
 
-    # Insert appointments and payments
-    appointment_ids = []
-    for slot in slots:
-        # Insert appointment
-        conn.execute("""
-            INSERT INTO appointments (patient_id, doctor_id, date, time, address, status)
-            VALUES (?, ?, ?, ?, ?, 'pending')
-        """, (session["user_id"], doctor_id, slot['date'], slot['time'], "Patient's address"))
-
-        # Get appointment ID
-        appointment_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-        appointment_ids.append(appointment_id)
-
-        # Process payment
-        payment_details = ""
-        if payment_method == "card":
-            card_number = request.form.get("card_number", "")
-            expiry_date = request.form.get("expiry_date", "")
-            cvv = request.form.get("cvv", "")
-            payment_details = f"Card: **** **** **** {card_number[-4:] if card_number else ''}"
-        elif payment_method == "upi":
-            upi_id = request.form.get("upi_id", "")
-            payment_details = f"UPI: {upi_id}"
-
-        # Record payment
-        conn.execute("""
-            INSERT INTO payments (appointment_id, user_id, amount, payment_method, payment_details, status)
-            VALUES (?, ?, ?, ?, ?, 'completed')
-        """, (appointment_id, session["user_id"], fees_per_slot, payment_method, payment_details))
+    # Process payment
+    payment_details = ""
+    if payment_method == "card":
+        card_number = request.form.get("card_number", "")
+        expiry_date = request.form.get("expiry_date", "")
+        cvv = request.form.get("cvv", "")
+        payment_details = f"Card: **** **** **** {card_number[-4:] if card_number else ''}"
+    elif payment_method == "upi":
+        upi_id = request.form.get("upi_id", "")
+        payment_details = f"UPI: {upi_id}"
+
+    # Insert all appointments in one multi-row statement; RETURNING hands back their ids
+    # (row order is unspecified, so they are sorted to keep the first slot's id first)
+    appointment_values = ",".join(["(?, ?, ?, ?, ?, 'pending')"] * len(slots))
+    appointment_ids = sorted(row[0] for row in conn.execute(f"""
+        INSERT INTO appointments (patient_id, doctor_id, date, time, address, status)
+        VALUES {appointment_values}
+        RETURNING id
+    """, [value for slot in slots
+          for value in (session["user_id"], doctor_id, slot['date'], slot['time'], "Patient's address")]))
+
+    # Record payments
+    conn.executemany("""
+        INSERT INTO payments (appointment_id, user_id, amount, payment_method, payment_details, status)
+        VALUES (?, ?, ?, ?, ?, 'completed')
+    """, [(appointment_id, session["user_id"], fees_per_slot, payment_method, payment_details)
+          for appointment_id in appointment_ids])
 
     # Get doctor user_id
     doctor_user_id = conn.execute("SELECT user_id FROM doctors WHERE id=?", (doctor_id,)).fetchone()["user_id"]
@@ -1548,12 +2037,40 @@ def confirm_payment():
     """, (doctor_user_id, message, appointment_ids[0]))  # Use first appointment ID for notification
 
     conn.commit()
-    conn.close()
 
     flash(f"{slot_count} appointment request(s) sent successfully! ₹{total_fees} has been deducted from your wallet.", "success")
     return redirect("/appointments")
 
 # ---------------- WALLET ----------------
+# For doctors: credits from accepted appointments
+_WALLET_DOCTOR_HISTORY_SQL = """
+    SELECT 1 AS part, 'credit' AS type, DATE(p.created_at) AS date, p.amount, p.created_at
+    FROM payments p
+    JOIN appointments a ON p.appointment_id = a.id
+    JOIN doctors d ON a.doctor_id = d.id
+    WHERE d.user_id=? AND p.status='completed' AND a.status='accepted'
+    ORDER BY p.created_at DESC
+    LIMIT 20
+"""
+# For patients: debits for payments, credits for refunds and top-ups
+_WALLET_PATIENT_HISTORY_SQL = """
+    SELECT 1 AS part,
+           CASE WHEN appointment_id IS NOT NULL AND status != 'refunded' THEN 'debit' ELSE 'credit' END AS type,
+           DATE(created_at) AS date, ABS(amount) AS amount, created_at
+    FROM payments
+    WHERE user_id=?
+    ORDER BY created_at DESC
+    LIMIT 20
+"""
+# part 0 is the balance row, part 1 the transaction history; one statement per role
+_WALLET_VIEW_SQL = {role: f"""
+    SELECT 0 AS part, NULL AS type, NULL AS date, balance AS amount, NULL AS created_at
+    FROM wallets WHERE user_id=?
+    UNION ALL
+    SELECT * FROM ({history})
+    ORDER BY part, created_at DESC
+""" for role, history in (("doctor", _WALLET_DOCTOR_HISTORY_SQL), ("user", _WALLET_PATIENT_HISTORY_SQL))}
+
 @app.route("/wallet")
 def wallet():
     if "user_id" not in session or session.get("role") not in ["user", "doctor"]:
@@ -1561,56 +2078,25 @@ def wallet():
 
     # Get back URL from request parameter or session
     back_url = request.args.get('back') or session.get('wallet_back_url')
-    if back_url:
-        session['wallet_back_url'] = back_url
+    if back_url and session.get('wallet_back_url') != back_url:
+        session['wallet_back_url'] = back_url  # only re-sign the cookie when it changes
     
     conn = get_db()
 
-    # Get wallet data
-    wallet_data = conn.execute("SELECT * FROM wallets WHERE user_id=?", (session["user_id"],)).fetchone()
+    # Balance row first, then the last 20 transactions, in one round trip
+    rows = conn.execute(_WALLET_VIEW_SQL[session["role"]], (session["user_id"], session["user_id"])).fetchall()
 
-    if not wallet_data:
-        # Create wallet if it doesn't exist
-        conn.execute("INSERT INTO wallets (user_id, balance) VALUES (?, 0.0)", (session["user_id"],))
-        conn.commit()
-        wallet_data = conn.execute("SELECT * FROM wallets WHERE user_id=?", (session["user_id"],)).fetchone()
-
-    # Get transaction history based on user role
-    if session.get("role") == "doctor":
-        # For doctors: show credits from accepted appointments
-        transactions = conn.execute("""
-            SELECT
-                'credit' as type,
-                DATE(p.created_at) as date,
-                p.amount
-            FROM payments p
-            JOIN appointments a ON p.appointment_id = a.id
-            JOIN doctors d ON a.doctor_id = d.id
-            WHERE d.user_id=? AND p.status='completed' AND a.status='accepted'
-            ORDER BY p.created_at DESC
-            LIMIT 20
-        """, (session["user_id"],)).fetchall()
+    if rows and rows[0]["part"] == 0:
+        balance, transactions = rows[0]["amount"], rows[1:]
     else:
-        # For patients: show debits for payments and credits for refunds
-        transactions = conn.execute("""
-            SELECT
-                CASE
-                    WHEN appointment_id IS NOT NULL AND status != 'refunded' THEN 'debit'
-                    WHEN appointment_id IS NOT NULL AND status = 'refunded' THEN 'credit'
-                    ELSE 'credit'
-                END as type,
-                DATE(created_at) as date,
-                ABS(amount) as amount
-            FROM payments
-            WHERE user_id=?
-            ORDER BY created_at DESC
-            LIMIT 20
-        """, (session["user_id"],)).fetchall()
+        # No wallet yet: only then take the writer to create it
+        conn = get_db(write=True)
+        conn.execute(_WALLET_ENSURE_SQL, (session["user_id"],))
+        conn.commit()
+        balance, transactions = 0.0, rows
 
     conn.close()
 
-    balance = wallet_data["balance"] if wallet_data else 0.0
-
     # Determine back URL with fallback
     if not back_url:
         back_url = '/doctor/dashboard' if session.get('role') == 'doctor' else '/dashboard'
@@ -1624,10 +2110,12 @@ def add_money():
         flash("Please login to access your wallet.", "danger")
         return redirect("/login")
 
-    # Validate amount
+    # Validate amount, parsed exactly so the decimal-places check is not fooled by float rounding
     try:
-        amount = float(request.form.get("amount", "").strip())
-    except (ValueError, TypeError):
+        amount = Decimal(request.form.get("amount", "").strip())
+    except (InvalidOperation, TypeError):
+        amount = None
+    if amount is None or not amount.is_finite():
         flash("Please enter a valid amount.", "danger")
         return redirect("/wallet")
 
@@ -1649,11 +2137,13 @@ def add_money():
         return redirect("/wallet")
 
     # Check if amount has more than 2 decimal places
-    if round(amount, 2) != amount:
+    paise = amount.scaleb(2)
+    if paise != paise.to_integral_value():
         flash("Amount can have at most 2 decimal places.", "danger")
         return redirect("/wallet")
+    amount = int(paise) / 100  # wallets and payments store rupees as REAL
 
-    conn = get_db()
+    conn = get_db(write=True)
 
     try:
         # Update wallet balance
@@ -1681,10 +2171,10 @@ def add_money():
         if return_url:
             return redirect(return_url)
 
-    except Exception as e:
+    except Exception:
         conn.rollback()
         flash("An error occurred while processing your request. Please try again.", "danger")
-        print(f"Error adding money to wallet: {e}")
+        app.logger.exception("Error adding money to wallet")
 
     finally:
         conn.close()
@@ -1706,44 +2196,46 @@ def process_payment():
     return redirect("/wallet")
 
 # ---------------- ACCEPT APPOINTMENT ----------------
+# Doctor's stored fees, or the specialty default when none are set (same rule as get_specialty_fees)
+_APPT_FEES_SQL = f"CASE WHEN d.fees > 0 THEN d.fees ELSE {_specialty_fees_sql('d.specialty')} END"
+_ACCEPT_CREDIT_DOCTOR_SQL = f"""
+    UPDATE wallets SET balance = balance + (
+        SELECT {_APPT_FEES_SQL} FROM appointments a
+        JOIN doctors d ON a.doctor_id = d.id
+        WHERE a.id=?
+    )
+    WHERE user_id=?
+"""
+_ACCEPT_NOTIFY_PATIENT_SQL = f"""
+    INSERT INTO notifications (user_id, message, type)
+    SELECT a.patient_id, printf(?, ?, a.date, a.time, {_APPT_FEES_SQL}), 'appointment_accepted'
+    FROM appointments a
+    JOIN doctors d ON a.doctor_id = d.id
+    WHERE a.id=?
+"""
+
 @app.route("/accept_appointment/<int:appointment_id>", methods=["POST"])
 def accept_appointment(appointment_id):
     if "user_id" not in session or session.get("role") != "doctor":
         return redirect("/login")
 
-    conn = get_db()
+    conn = begin_immediate(get_db(write=True))
 
-    # Get appointment details first to verify it exists and belongs to the doctor
-    appointment = conn.execute("""
-        SELECT a.*, d.fees, d.specialty FROM appointments a
-        JOIN doctors d ON a.doctor_id = d.id
-        WHERE a.id=? AND d.user_id=?
-    """, (appointment_id, session["user_id"])).fetchone()
+    # Update appointment status to accepted; the doctor_id match doubles as the ownership check
+    accepted = conn.execute("""
+        UPDATE appointments SET status='accepted' WHERE id=? AND doctor_id=?
+    """, (appointment_id, current_doctor_id(conn))).rowcount
 
-    if not appointment:
+    if not accepted:
         conn.close()
         flash("Appointment not found or access denied.", "danger")
         return redirect("/doctor/notifications")
 
-    # Calculate fees based on doctor's stored fees or specialty
-    fees = appointment['fees'] if appointment['fees'] and appointment['fees'] > 0 else get_specialty_fees(appointment['specialty'])
-
-    # Update appointment status to accepted
-    conn.execute("""
-        UPDATE appointments SET status='accepted' WHERE id=?
-    """, (appointment_id,))
-
-    # Add fees to doctor's wallet
-    conn.execute("""
-        UPDATE wallets SET balance = balance + ? WHERE user_id=?
-    """, (fees, session["user_id"]))
+    # Add fees to doctor's wallet (fees resolved in SQL from the doctor's profile or specialty)
+    conn.execute(_ACCEPT_CREDIT_DOCTOR_SQL, (appointment_id, session["user_id"]))
 
     # Create notification for patient
-    patient_message = f"Your appointment with Dr. {session.get('name')} on {appointment['date']} at {appointment['time']} has been accepted. ₹{fees} has been deducted from your wallet."
-    conn.execute("""
-        INSERT INTO notifications (user_id, message, type)
-        VALUES (?, ?, 'appointment_accepted')
-    """, (appointment['patient_id'], patient_message))
+    conn.execute(_ACCEPT_NOTIFY_PATIENT_SQL, (_MSG_APPT_ACCEPTED, session.get('name'), appointment_id))
 
     # Delete the notification from doctor's view
     conn.execute("""
@@ -1764,7 +2256,7 @@ def reject_appointment(appointment_id):
 
     delete_notification = request.args.get('delete_notification', 'false').lower() == 'true'
 
-    conn = get_db()
+    conn = begin_immediate(get_db(write=True))
 
     # Get appointment details first to verify it exists and belongs to the doctor
     appointment = conn.execute("""
@@ -1824,14 +2316,9 @@ def reject_appointment(appointment_id):
 
     # Create notification for patient
     if refund_amount > 0:
-        patient_message = f"Your appointment with Dr. {session.get('name')} on {appointment['date']} at {appointment['time']} has been rejected. Rs {refund_amount} has been refunded to your wallet."
+        notify_appointment(conn, appointment, _MSG_APPT_REJECTED_REFUND, 'appointment_rejected', refund_amount)
     else:
-        patient_message = f"Your appointment with Dr. {session.get('name')} on {appointment['date']} at {appointment['time']} has been rejected."
-
-    conn.execute("""
-        INSERT INTO notifications (user_id, message, type)
-        VALUES (?, ?, 'appointment_rejected')
-    """, (appointment['patient_id'], patient_message))
+        notify_appointment(conn, appointment, _MSG_APPT_REJECTED, 'appointment_rejected')
 
     # Mark notification as read and optionally delete it
     if delete_notification:
@@ -1855,14 +2342,14 @@ def doctor_cancel_appointment(appointment_id):
     if "user_id" not in session or session.get("role") != "doctor":
         return {"success": False, "message": "Unauthorized"}, 401
 
-    conn = get_db()
+    conn = begin_immediate(get_db(write=True))
 
     # Get appointment details
     appointment = conn.execute("""
         SELECT a.*, d.fees FROM appointments a
         JOIN doctors d ON a.doctor_id = d.id
-        WHERE a.id=? AND a.doctor_id=(SELECT id FROM doctors WHERE user_id=?)
-    """, (appointment_id, session["user_id"])).fetchone()
+        WHERE a.id=? AND a.doctor_id=?
+    """, (appointment_id, current_doctor_id(conn))).fetchone()
 
     if not appointment:
         conn.close()
@@ -1892,11 +2379,7 @@ def doctor_cancel_appointment(appointment_id):
     conn.execute("DELETE FROM appointments WHERE id=?", (appointment_id,))
 
     # Create notification for patient
-    patient_message = f"Your appointment with Dr. {session.get('name')} on {appointment['date']} at {appointment['time']} has been cancelled. ₹{fees} has been refunded to your wallet."
-    conn.execute("""
-        INSERT INTO notifications (user_id, message, type)
-        VALUES (?, ?, 'appointment_cancelled')
-    """, (appointment['patient_id'], patient_message))
+    notify_appointment(conn, appointment, _MSG_APPT_CANCELLED, 'appointment_cancelled', fees)
 
     conn.commit()
     conn.close()
@@ -1914,8 +2397,8 @@ def appointment_details(appointment_id):
         SELECT a.*, u.fname as patient_fname, u.lname as patient_lname, u.patient_city, u.patient_state, u.patient_pincode, u.patient_address
         FROM appointments a
         JOIN users u ON a.patient_id = u.id
-        WHERE a.id=? AND a.doctor_id=(SELECT id FROM doctors WHERE user_id=?)
-    """, (appointment_id, session["user_id"])).fetchone()
+        WHERE a.id=? AND a.doctor_id=?
+    """, (appointment_id, current_doctor_id(conn))).fetchone()
     conn.close()
 
     if not appointment:
@@ -1924,6 +2407,14 @@ def appointment_details(appointment_id):
     return {"success": True, "appointment": dict(appointment)}
 
 # ---------------- DOCTOR PATIENTS LIST ----------------
+def _patient_address(patient):
+    """Address dict for a patient row (Data Structure: Dictionary)"""
+    return {
+        'city': patient['patient_city'], 'state': patient['patient_state'],
+        'pincode': patient['patient_pincode'], 'address': patient['patient_address'],
+        'latitude': patient['patient_latitude'], 'longitude': patient['patient_longitude']
+    }
+
 @app.route("/doctor/patients")
 def doctor_patients():
     if "user_id" not in session or session.get("role") != "doctor":
@@ -1936,7 +2427,7 @@ def doctor_patients():
     doctor_id = doctor["id"]
 
     # Get all patients who have had appointments with this doctor
-    patients = conn.execute("""
+    patients = fetch_dicts(conn, """
         SELECT
             u.id,
             u.fname,
@@ -1957,42 +2448,48 @@ def doctor_patients():
         ))
         GROUP BY u.id, u.fname, u.lname, u.email, u.patient_address, u.patient_city, u.patient_state, u.patient_pincode, u.patient_latitude, u.patient_longitude
         ORDER BY last_visit DESC, appointment_count DESC
-    """, (doctor_id, doctor_id)).fetchall()
+    """, (doctor_id, doctor_id))
 
-    # Calculate distances for each patient
-    patients_with_distance = []
-    for patient in patients:
-        patient_dict = dict(patient)
+    # Distance from the doctor's hospital to every patient in one vectorized pass
+    distances = DistanceCalculator.calculate_distances(
+        DoctorSorter._doctor_address(doctor), patients, to_addr=_patient_address,
+        lat_key='patient_latitude', lon_key='patient_longitude')
 
-        # Calculate distance from patient to doctor's hospital
-        doctor_addr = {
-            'city': doctor['city'],
-            'state': doctor['state'],
-            'pincode': doctor['pincode'],
-            'address': doctor['full_address'],
-            'latitude': doctor['latitude'],
-            'longitude': doctor['longitude']
-        }
-
-        patient_addr = {
-            'city': patient['patient_city'],
-            'state': patient['patient_state'],
-            'pincode': patient['patient_pincode'],
-            'address': patient['patient_address'],
-            'latitude': patient['patient_latitude'],
-            'longitude': patient['patient_longitude']
-        }
-
-        distance = DistanceCalculator.calculate_distance(patient_addr, doctor_addr)
-        patient_dict['distance'] = f"{distance:.1f} km" if distance != -1 else "N/A"
-
-        patients_with_distance.append(patient_dict)
+    for patient, distance in zip(patients, distances.tolist()):
+        patient['distance'] = f"{distance:.1f} km" if distance != -1 else "N/A"
+        # Coordinates were only needed for the distance; keep them out of the response
+        del patient['patient_latitude'], patient['patient_longitude']
 
     conn.close()
 
-    return {"success": True, "patients": patients_with_distance}
+    return {"success": True, "patients": patients}
 
 # ---------------- DELETE APPOINTMENTS BY DATE ----------------
+# Set-based versions of the per-appointment refund/cancel steps, all keyed on (doctor_id, date)
+_DAY_ACCEPTED = "doctor_id=? AND date=? AND status='accepted'"
+_DAY_REFUND_WALLETS_SQL = f"""
+    UPDATE wallets SET balance = balance + (
+        SELECT SUM(d.fees) FROM appointments a
+        JOIN doctors d ON a.doctor_id = d.id
+        WHERE a.patient_id = wallets.user_id AND a.doctor_id=? AND a.date=? AND a.status='accepted'
+    )
+    WHERE user_id IN (SELECT patient_id FROM appointments WHERE {_DAY_ACCEPTED})
+"""
+_DAY_REFUND_PAYMENTS_SQL = f"""
+    UPDATE payments SET status='refunded'
+    WHERE appointment_id IN (SELECT id FROM appointments WHERE {_DAY_ACCEPTED})
+"""
+_DAY_CANCEL_NOTIFICATIONS_SQL = """
+    INSERT INTO notifications (user_id, message, type)
+    SELECT a.patient_id,
+           printf(?, ?, a.date, a.time, d.fees),
+           'appointment_cancelled'
+    FROM appointments a
+    JOIN doctors d ON a.doctor_id = d.id
+    WHERE a.doctor_id=? AND a.date=? AND a.status='accepted'
+"""
+_DAY_DELETE_APPOINTMENTS_SQL = f"DELETE FROM appointments WHERE {_DAY_ACCEPTED}"
+
 @app.route("/delete_appointments_by_date", methods=["POST"])
 def delete_appointments_by_date():
     if "user_id" not in session or session.get("role") != "doctor":
@@ -2002,43 +2499,25 @@ def delete_appointments_by_date():
     if not selected_date:
         return {"success": False, "message": "Date not provided"}, 400
 
-    conn = get_db()
+    conn = begin_immediate(get_db(write=True))
 
-    # Get doctor's ID
-    doctor_id = conn.execute("SELECT id FROM doctors WHERE user_id=?", (session["user_id"],)).fetchone()["id"]
+    day = (current_doctor_id(conn), selected_date)
 
-    # Get all appointments for this date and doctor
-    appointments = conn.execute("""
-        SELECT a.*, d.fees FROM appointments a
-        JOIN doctors d ON a.doctor_id = d.id
-        WHERE a.doctor_id=? AND a.date=? AND a.status='accepted'
-    """, (doctor_id, selected_date)).fetchall()
-
-    if not appointments:
+    # Create notification for each of the day's accepted appointments; the row
+    # count doubles as the "anything to cancel?" check
+    notified = conn.execute(_DAY_CANCEL_NOTIFICATIONS_SQL, (_MSG_APPT_CANCELLED, session.get('name')) + day).rowcount
+    if not notified:
         conn.close()
         return {"success": False, "message": "No appointments found for this date"}, 404
 
-    # Process each appointment
-    for appointment in appointments:
-        # Refund fee to patient's wallet
-        conn.execute("""
-            UPDATE wallets SET balance = balance + ? WHERE user_id=?
-        """, (appointment['fees'], appointment['patient_id']))
-
-        # Update payment status to refunded
-        conn.execute("""
-            UPDATE payments SET status='refunded' WHERE appointment_id=?
-        """, (appointment['id'],))
+    # Refund fees to each patient's wallet (summed when a patient had several slots)
+    conn.execute(_DAY_REFUND_WALLETS_SQL, day + day)
 
-        # Create notification for patient
-        patient_message = f"Your appointment with Dr. {session.get('name')} on {appointment['date']} at {appointment['time']} has been cancelled. ₹{appointment['fees']} has been refunded to your wallet."
-        conn.execute("""
-            INSERT INTO notifications (user_id, message, type)
-            VALUES (?, ?, 'appointment_cancelled')
-        """, (appointment['patient_id'], patient_message))
+    # Update payment status to refunded
+    conn.execute(_DAY_REFUND_PAYMENTS_SQL, day)
 
-        # Delete the appointment
-        conn.execute("DELETE FROM appointments WHERE id=?", (appointment['id'],))
+    # Delete the appointments
+    conn.execute(_DAY_DELETE_APPOINTMENTS_SQL, day)
 
     conn.commit()
     conn.close()
@@ -2052,7 +2531,7 @@ def chat(doctor_id):
         return redirect("/login")
 
     conn = get_db()
-    doctor = conn.execute("SELECT * FROM doctors WHERE id=?", (doctor_id,)).fetchone()
+    doctor = conn.execute("SELECT id, fname, lname, specialty FROM doctors WHERE id=?", (doctor_id,)).fetchone()
     conn.close()
 
     if not doctor:
@@ -2072,15 +2551,13 @@ def consult_appointment(appointment_id):
     appointment = conn.execute("""
         SELECT a.*, u.fname as patient_fname, u.lname as patient_lname,
                u.email as patient_email, u.patient_city, u.patient_state,
-               u.patient_address, d.fname as doctor_fname, d.lname as doctor_lname
+               u.patient_address, d.fname as doctor_fname, d.lname as doctor_lname,
+               (SELECT unread_notifications FROM users WHERE id=?) as notifications_count
         FROM appointments a
         JOIN users u ON a.patient_id = u.id
         JOIN doctors d ON a.doctor_id = d.id
-        WHERE a.id=? AND a.doctor_id=(SELECT id FROM doctors WHERE user_id=?)
-    """, (appointment_id, session["user_id"])).fetchone()
-
-    # Get unread notifications count
-    notifications_count = conn.execute("SELECT COUNT(*) as count FROM notifications WHERE user_id=? AND read=0", (session["user_id"],)).fetchone()["count"]
+        WHERE a.id=? AND a.doctor_id=?
+    """, (session["user_id"], appointment_id, current_doctor_id(conn))).fetchone()
 
     conn.close()
 
@@ -2088,7 +2565,11 @@ def consult_appointment(appointment_id):
         flash("Appointment not found or access denied.", "danger")
         return redirect("/doctor/appointments")
 
-    return render_template("consult_appointment.html", appointment=dict(appointment), notifications_count=notifications_count)
+    # Unread notifications count comes from the trigger-maintained users column
+    appointment = dict(appointment)
+    notifications_count = appointment.pop("notifications_count")
+
+    return render_template("consult_appointment.html", appointment=appointment, notifications_count=notifications_count)
 
 # ---------------- PRESCRIPTION PAGE ----------------
 @app.route("/prescription/<int:appointment_id>")
@@ -2106,15 +2587,15 @@ def prescription_page(appointment_id):
         FROM appointments a
         JOIN users u ON a.patient_id = u.id
         JOIN doctors d ON a.doctor_id = d.id
-        WHERE a.id=? AND a.doctor_id=(SELECT id FROM doctors WHERE user_id=?)
-    """, (appointment_id, session["user_id"])).fetchone()
+        WHERE a.id=? AND a.doctor_id=?
+    """, (appointment_id, current_doctor_id(conn))).fetchone()
 
     # Get existing prescriptions for this appointment
-    prescriptions = conn.execute("""
+    prescriptions = fetch_dicts(conn, """
         SELECT * FROM prescriptions
         WHERE appointment_id=?
         ORDER BY created_at ASC
-    """, (appointment_id,)).fetchall()
+    """, (appointment_id,))
 
     conn.close()
 
@@ -2122,9 +2603,25 @@ def prescription_page(appointment_id):
         flash("Appointment not found or access denied.", "danger")
         return redirect("/doctor/appointments")
 
-    return render_template("prescription.html", appointment=dict(appointment), prescriptions=[dict(p) for p in prescriptions])
+    return render_template("prescription.html", appointment=dict(appointment), prescriptions=prescriptions)
 
 # ---------------- SAVE PRESCRIPTION ----------------
+def _prescription_row(appointment_id, medicine):
+    """Parameter tuple for one prescriptions INSERT"""
+    tablets = medicine["tablets"] or 1
+    duration = medicine["duration"] or 1
+    return (
+        appointment_id,
+        medicine["medicine_name"],
+        tablets,
+        medicine["timing"],
+        medicine["before_after_eat"],
+        medicine["price"],
+        duration,
+        tablets * duration,  # medicine_supplied
+        0
+    )
+
 @app.route("/save_prescription/<int:appointment_id>", methods=["POST"])
 def save_prescription(appointment_id):
     if "user_id" not in session or session.get("role") != "doctor":
@@ -2137,47 +2634,33 @@ def save_prescription(appointment_id):
         if not medicines:
             return {"success": False, "message": "No medicines provided"}, 400
 
-        conn = get_db()
+        conn = begin_immediate(get_db(write=True))
 
         # Verify appointment belongs to doctor
         appointment = conn.execute("""
             SELECT id FROM appointments
-            WHERE id=? AND doctor_id=(SELECT id FROM doctors WHERE user_id=?)
-        """, (appointment_id, session["user_id"])).fetchone()
+            WHERE id=? AND doctor_id=?
+        """, (appointment_id, current_doctor_id(conn))).fetchone()
 
         if not appointment:
             conn.close()
             return {"success": False, "message": "Appointment not found or access denied"}, 404
 
-        # Insert each medicine
-        for medicine in medicines:
-            tablets = medicine["tablets"] or 1
-            duration = medicine["duration"] or 1
-            medicine_supplied = tablets * duration
-            
-            conn.execute("""
-                INSERT INTO prescriptions
-                (appointment_id, medicine_name, tablets, timing, before_after_eat, price, duration, medicine_supplied, medicine_consumed)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                appointment_id,
-                medicine["medicine_name"],
-                tablets,
-                medicine["timing"],
-                medicine["before_after_eat"],
-                medicine["price"],
-                duration,
-                medicine_supplied,
-                0
-            ))
+        # Build every row first (a missing key fails here, before any insert), then insert in one batch
+        rows = [_prescription_row(appointment_id, medicine) for medicine in medicines]
+        conn.executemany("""
+            INSERT INTO prescriptions
+            (appointment_id, medicine_name, tablets, timing, before_after_eat, price, duration, medicine_supplied, medicine_consumed)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
 
         conn.commit()
         conn.close()
 
         return {"success": True, "message": "Prescription saved successfully"}
 
-    except Exception as e:
-        print(f"Error saving prescription: {e}")
+    except Exception:
+        app.logger.exception("Error saving prescription")
         return {"success": False, "message": "Error saving prescription"}, 500
 
 # ---------------- UPDATE MEDICINE CONSUMED ----------------
@@ -2190,7 +2673,7 @@ def update_medicine_consumed(prescription_id):
         data = request.get_json()
         medicine_consumed = data.get("medicine_consumed", 0)
 
-        conn = get_db()
+        conn = get_db(write=True)
 
         # Verify prescription belongs to patient
         prescription = conn.execute("""
@@ -2221,8 +2704,8 @@ def update_medicine_consumed(prescription_id):
 
         return {"success": True, "message": "Medicine consumed updated successfully"}
 
-    except Exception as e:
-        print(f"Error updating medicine consumed: {e}")
+    except Exception:
+        app.logger.exception("Error updating medicine consumed")
         return {"success": False, "message": "Error updating medicine consumed"}, 500
 
 # ---------------- LOGOUT ----------------
@@ -2236,13 +2719,13 @@ def logout():
 @app.route("/doctors_report")
 def doctors_report():
     conn = get_db()
+    # The template loops over the rows once, so hand it the cursor instead of a fetched list
     doctors = conn.execute("""
         SELECT specialty, fname, lname, fees
         FROM doctors
         WHERE profile_complete=1
         ORDER BY specialty, fees
-    """).fetchall()
-    conn.close()
+    """)
     return render_template("doctors_report.html", doctors=doctors)
 
 # ---------------- ADD CUSTOMER ----------------
@@ -2254,7 +2737,7 @@ def add_customer():
     data = request.get_json()
     conn = None
     try:
-        conn = get_db()
+        conn = get_db(write=True)
         conn.execute("""INSERT INTO users (fname, lname, email, mobile, patient_city, patient_state, role) VALUES (?, ?, ?, ?, ?, ?, 'user')""", (data['fname'], data['lname'], data['email'], data['mobile'], data['city'], data['state']))
         conn.commit()
         return {"success": True}
@@ -2275,9 +2758,21 @@ def get_customers():
         return {"success": False, "message": "Unauthorized"}, 401
 
     conn = get_db()
-    customers = conn.execute("SELECT * FROM users WHERE role='user' ORDER BY fname, lname").fetchall()
-    conn.close()
-    return {"success": True, "customers": [dict(c) for c in customers]}
+    # Only the fields the customer cards render (never passwords or coordinates)
+    cursor = conn.execute("""
+        SELECT id, fname, lname, email, mobile, patient_city, patient_state
+        FROM users WHERE role='user' ORDER BY fname, lname
+    """)
+
+    def generate():
+        """Stream the same JSON body as {"success": True, "customers": [...]}, one row at a time"""
+        yield '{"customers":['
+        for i, customer in enumerate(cursor):
+            yield ("," if i else "") + app.json.dumps(customer, separators=(",", ":"))
+        yield '],"success":true}\n'
+
+    # stream_with_context keeps the request (and its pooled connection) alive until the last row
+    return Response(stream_with_context(generate()), mimetype="application/json")
 
 # ---------------- CUSTOMERS LIST ----------------
 @app.route("/customers")
@@ -2307,10 +2802,9 @@ def add_weight():
         notes = request.form.get("notes", "")
 
         if not date:
-            from datetime import datetime
             date = datetime.now().strftime('%Y-%m-%d')
 
-        conn = get_db()
+        conn = get_db(write=True)
         conn.execute("""
             INSERT INTO weight_tracking (user_id, weight, date, notes)
             VALUES (?, ?, ?, ?)
@@ -2338,378 +2832,400 @@ def weight_history():
 
     return render_template("weight_history.html", weights=weights)
 
-def _style_vitals_axes(ax, fig):
-    """Shared premium chart styling for patient vitals."""
-    fig.patch.set_facecolor('#0b0f1a')
-    ax.set_facecolor('#121b2d')
-
-    ax.spines['left'].set_color('#334155')
-    ax.spines['bottom'].set_color('#334155')
-    ax.spines['top'].set_color('#121b2d')
-    ax.spines['right'].set_color('#121b2d')
-
-    ax.tick_params(colors='#cbd5e1', labelsize=9)
-    ax.grid(axis='y', color='#334155', alpha=0.22, linestyle='-', linewidth=0.8)
-    ax.grid(axis='x', alpha=0.0)
-
-def _plot_glow_series(ax, x, y, color, label=None, show_slope=False):
-    """Draw a matte pro line series with optional slope trendline."""
-    ax.plot(
-        x, y, color=color, linewidth=2.4, alpha=0.95,
-        solid_joinstyle='round', solid_capstyle='round', label=label
-    )
-    ax.scatter(x, y, s=14, color=color, alpha=0.9, zorder=4)
-
-    if y:
-        ax.scatter([x[-1]], [y[-1]], s=34, color=color, edgecolors='#0b0f1a', linewidths=0.9, zorder=5)
-        ax.annotate(
-            f"{y[-1]:.1f}" if isinstance(y[-1], float) else f"{y[-1]}",
-            (x[-1], y[-1]),
-            textcoords="offset points",
-            xytext=(8, -10),
-            color='#e2e8f0',
-            fontsize=8.5,
-            fontweight='bold'
-        )
-
-    # Add linear slope/trend line for better direction visibility
-    if show_slope and len(y) >= 2:
-        n = len(x)
-        sx = sum(x)
-        sy = sum(y)
-        sxy = sum(x[i] * y[i] for i in range(n))
-        sx2 = sum(xi * xi for xi in x)
-        den = (n * sx2) - (sx * sx)
-        if den != 0:
-            slope = ((n * sxy) - (sx * sy)) / den
-            intercept = (sy - slope * sx) / n
-            trend = [slope * xi + intercept for xi in x]
-            ax.plot(x, trend, color='#94a3b8', linewidth=1.0, linestyle='--', alpha=0.45)
-
-@app.route("/weight_chart")
-def weight_chart():
-    if "user_id" not in session or session.get("role") != "user":
-        return redirect("/login")
+# ---------------- VITALS CHART CACHE ----------------
+# weight_tracking is insert-only, so (max id, max created_at, row count) changes whenever
+# a user's chart would; rendered bytes are reused until then (Data Structure: LRU OrderedDict)
+_VITALS_STAMP_SQL = "SELECT MAX(id), MAX(created_at), COUNT(*) FROM weight_tracking WHERE user_id=?"
+_CHART_CACHE_SIZE = 256
+_VITALS_ROWS_SQL = """
+    SELECT date, weight, height, bp_systolic, bp_diastolic FROM weight_tracking
+    WHERE user_id=?
+    ORDER BY date ASC, id ASC
+"""
+_chart_cache = collections.OrderedDict()
+_chart_cache_lock = threading.Lock()
+
+def _cached_chart(conn, kind, mimetype, render):
+    """Serve a vitals chart from the LRU cache (or a 304), calling render() only on a miss.
+    render() returns the encoded body, so cache hits go out without another copy or encode."""
+    user_id = session["user_id"]
+    key = (user_id, kind, tuple(conn.execute(_VITALS_STAMP_SQL, (user_id,)).fetchone()))
+    etag = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        with _chart_cache_lock:
+            body = _chart_cache.get(key)
+            if body is not None:
+                _chart_cache.move_to_end(key)
+        if body is None:
+            body = render()
+            with _chart_cache_lock:
+                _chart_cache[key] = body
+                if len(_chart_cache) > _CHART_CACHE_SIZE:
+                    _chart_cache.popitem(last=False)
+        response = Response(body, content_type=mimetype)
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, max-age=60'
+    return response
 
+def _vitals_rows(user_id):
+    """All of a user's vitals readings in chart order, queried once per request and kept on g"""
+    rows = g.get("vitals_rows")
+    if rows is None:
+        rows = g.vitals_rows = get_db().execute(_VITALS_ROWS_SQL, (user_id,)).fetchall()
+    return rows
+
+# Per chart type: value columns, legend labels, colours and the text/size both renderers use
+_VitalsChart = collections.namedtuple(
+    "_VitalsChart", "columns labels colors title ylabel empty_message png_size")
+_VITALS_CHARTS = {
+    "weight": _VitalsChart(("weight",), (None,), ('#22d3ee',), 'Weight History', 'Weight (kg)',
+                           'No weight data available', (1440, 792)),
+    "height": _VitalsChart(("height",), (None,), ('#2dd4bf',), 'Height History', 'Height (cm)',
+                           'No height data available', (1200, 624)),
+    "bp": _VitalsChart(("bp_systolic", "bp_diastolic"), ('Systolic', 'Diastolic'), ('#22d3ee', '#38bdf8'),
+                       'Blood Pressure', 'mmHg', 'No blood pressure data available', (1200, 624)),
+}
+
+def _vitals_series(chart):
+    """Dates and (label, values, colour) series for one chart, skipping readings it can't plot.
+    One pass pulls (date, *values) out of each row; zip(*) then splits them into columns."""
+    picked = [values for values in map(operator.itemgetter("date", *chart.columns), _vitals_rows(session["user_id"]))
+              if None not in values[1:]]
+    dates, *columns = zip(*picked) if picked else [()] * (len(chart.columns) + 1)
+    return dates, list(zip(chart.labels, columns, chart.colors))
+
+# ---------------- CHART GEOMETRY ----------------
+def _nice_ticks(lo, hi, count=6):
+    """Round-number y ticks covering [lo, hi] (1/2/2.5/5 x 10^k steps)"""
+    raw = (hi - lo) / max(count - 1, 1)
+    magnitude = 10 ** math.floor(math.log10(raw))
+    step = next(m * magnitude for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw)
+    first = math.ceil(lo / step) * step
+    return [first + i * step for i in range(int((hi - first) / step + 1e-9) + 1)]
+
+def _format_tick(value):
+    """Tick label without trailing .0 noise"""
+    return f"{value:.0f}" if float(value).is_integer() else f"{value:g}"
+
+def _value_label(value):
+    """Last-reading annotation: one decimal for REAL readings, integers as they are"""
+    return f"{value:.1f}" if isinstance(value, float) else f"{value}"
+
+def _value_range(values):
+    """Plotted y range: the span of the values padded by 5%, widened when they are all equal"""
+    lo, hi = min(values), max(values)
+    if lo == hi:
+        lo, hi = lo - 1, hi + 1
+    pad = (hi - lo) * 0.05
+    return lo - pad, hi + pad
+
+def _trend_line(y):
+    """Least-squares trend values for readings plotted at x = 0..n-1, or None for fewer than 2 points.
+    Sum(x) and sum(x^2) over those positions have closed forms, so only y needs reducing."""
+    n = len(y)
+    if n < 2:
+        return None
+    xa = np.arange(n, dtype=np.float64)
+    ya = np.asarray(y, dtype=np.float64)
+    sx = n * (n - 1) / 2
+    sx2 = (n - 1) * n * (2 * n - 1) / 6
+    sy = ya.sum()
+    sxy = xa @ ya
+    den = (n * sx2) - (sx * sx)  # n^2 (n^2 - 1) / 12, never 0 for n >= 2
+    slope = ((n * sxy) - (sx * sy)) / den
+    intercept = (sy - slope * sx) / n
+    return slope * xa + intercept
+
+# ---------------- PNG CHART RENDERER ----------------
+# ImageDraw does not antialias, so charts are drawn at 2x and box-filtered down once at the end
+_PNG_SUPERSAMPLE = 2
+
+@functools.lru_cache(maxsize=None)
+def _chart_font(size, bold=False):
+    """DejaVu Sans when the system has it, otherwise Pillow's bundled font, at a pixel size"""
     try:
-        import matplotlib
-        matplotlib.use('Agg')  # Use non-interactive backend
-        import matplotlib.pyplot as plt
-        from io import BytesIO
-    except ImportError:
-        return {"success": False, "message": "Matplotlib not available"}, 500
+        return ImageFont.truetype("DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf", size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+def _blend(color, alpha, background='#121b2d'):
+    """Opaque RGB for a colour drawn at the given alpha over the plot background"""
+    fg, bg = ImageColor.getrgb(color), ImageColor.getrgb(background)
+    return tuple(round(b + (f - b) * alpha) for f, b in zip(fg, bg))
+
+def _text_mask(text, font, angle):
+    """Greyscale mask of a text label rotated counter-clockwise by angle degrees"""
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new("L", (right, bottom))
+    ImageDraw.Draw(mask).text((0, 0), text, font=font, fill=255)
+    return mask.rotate(angle, resample=Image.BICUBIC, expand=True)
+
+def _paste_text(im, xy, mask, color):
+    """Fill a text mask in one colour with its top-left corner at xy"""
+    x, y = round(xy[0]), round(xy[1])
+    im.paste(color, (x, y, x + mask.width, y + mask.height), mask)
+
+def _dashed_line(draw, start, end, fill, width, dash, gap):
+    """Straight dashed segment from start to end"""
+    (x0, y0), (x1, y1) = start, end
+    length = math.hypot(x1 - x0, y1 - y0)
+    if not length:
+        return
+    ux, uy = (x1 - x0) / length, (y1 - y0) / length
+    pos = 0.0
+    while pos < length:
+        stop = min(pos + dash, length)
+        draw.line([(x0 + ux * pos, y0 + uy * pos), (x0 + ux * stop, y0 + uy * stop)], fill=fill, width=width)
+        pos = stop + gap
+
+def render_chart_png(x_labels, series, title, ylabel, empty_message, size):
+    """
+    Vitals line chart as PNG bytes, drawn with Pillow in the same palette as the SVG charts.
+    series is a list of (legend label or None, values, colour), as for render_line_svg().
+    """
+    s = _PNG_SUPERSAMPLE
+    width, height = size[0] * s, size[1] * s
+    im = Image.new("RGB", (width, height), '#0b0f1a')
+    draw = ImageDraw.Draw(im)
+    tick_font, label_font = _chart_font(15 * s), _chart_font(17 * s)
+    left, top, right, bottom = 96 * s, 58 * s, width - 28 * s, height - 122 * s
+    draw.rectangle((left, top, right, bottom), fill='#121b2d')
+
+    draw.text(((left + right) / 2, 30 * s), title, fill='#e2e8f0', font=_chart_font(22 * s, bold=True), anchor="mm")
+
+    n = len(x_labels)
+    trends = [_trend_line(ys) for _, ys, _ in series]
+    values = [v for _, ys, _ in series for v in ys]
+    values += [t for trend in trends if trend is not None for t in (trend[0], trend[-1])]  # keep trends in view
+    if n and values:
+        lo, hi = _value_range(values)
+
+        def px(i):
+            return (left + right) / 2 if n == 1 else left + (right - left) * (0.03 + 0.94 * i / (n - 1))
+
+        def py(v):
+            return bottom - (v - lo) / (hi - lo) * (bottom - top)
+
+        # Horizontal grid and y tick labels
+        grid = _blend('#334155', 0.22)
+        for tick in _nice_ticks(lo, hi):
+            y = py(tick)
+            draw.line([(left, y), (right, y)], fill=grid, width=s)
+            draw.text((left - 10 * s, y), _format_tick(tick), fill='#cbd5e1', font=tick_font, anchor="rm")
+
+        # x tick labels rotated 28 degrees, each ending under its tick
+        for i, label in enumerate(x_labels):
+            x = px(i)
+            draw.line([(x, bottom), (x, bottom + 6 * s)], fill='#cbd5e1', width=s)
+            mask = _text_mask(str(label), tick_font, 28)
+            _paste_text(im, (x - mask.width, bottom + 10 * s), mask, ImageColor.getrgb('#cbd5e1'))
+
+        for (_, ys, color), trend in zip(series, trends):
+            points = [(px(i), py(v)) for i, v in enumerate(ys)]
+            if trend is not None:
+                # The trend is a straight line, so its two end points are enough
+                _dashed_line(draw, (points[0][0], py(trend[0])), (points[-1][0], py(trend[-1])),
+                             _blend('#94a3b8', 0.45), 2 * s, 7 * s, 5 * s)
+            if n > 1:
+                draw.line(points, fill=_blend(color, 0.95), width=4 * s, joint="curve")
+            dot = _blend(color, 0.9)
+            for x, y in points:
+                draw.ellipse((x - 3 * s, y - 3 * s, x + 3 * s, y + 3 * s), fill=dot)
+            if points:
+                x, y = points[-1]
+                draw.ellipse((x - 5 * s, y - 5 * s, x + 5 * s, y + 5 * s), fill=color, outline='#0b0f1a', width=2 * s)
+                draw.text((x + 13 * s, y + 17 * s), _value_label(ys[-1]), fill='#e2e8f0',
+                          font=_chart_font(14 * s, bold=True), anchor="ls")
+
+        # Legend for multi-series charts
+        labelled = [(label, color) for label, _, color in series if label]
+        if labelled:
+            x0, y0 = left + 14 * s, top + 14 * s
+            box_width = 40 * s + max(draw.textlength(label, font=tick_font) for label, _ in labelled) + 14 * s
+            draw.rounded_rectangle((x0, y0, x0 + box_width, y0 + (12 + 24 * len(labelled)) * s), radius=5 * s,
+                                   fill='#121b2d', outline='#334155', width=s)
+            for k, (label, color) in enumerate(labelled):
+                y = y0 + (18 + 24 * k) * s
+                draw.line([(x0 + 10 * s, y), (x0 + 34 * s, y)], fill=color, width=4 * s)
+                draw.text((x0 + 40 * s, y), label, fill='#cbd5e1', font=tick_font, anchor="lm")
+    else:
+        draw.text(((left + right) / 2, (top + bottom) / 2), empty_message, fill='#94a3b8',
+                  font=_chart_font(20 * s, bold=True), anchor="mm")
 
-    conn = get_db()
-    weights = conn.execute("""
-        SELECT date, weight FROM weight_tracking
-        WHERE user_id=? AND weight IS NOT NULL
-        ORDER BY date ASC, id ASC
-    """, (session["user_id"],)).fetchall()
-    conn.close()
+    # Axes spines and labels
+    draw.line([(left, top), (left, bottom)], fill='#334155', width=s)
+    draw.line([(left, bottom), (right, bottom)], fill='#334155', width=s)
+    draw.text(((left + right) / 2, height - 20 * s), 'Date', fill='#cbd5e1', font=label_font, anchor="ms")
+    mask = _text_mask(ylabel, label_font, 90)
+    _paste_text(im, (14 * s, (top + bottom - mask.height) / 2), mask, ImageColor.getrgb('#cbd5e1'))
 
-    fig, ax = plt.subplots(figsize=(12, 6.6), dpi=120)
-    _style_vitals_axes(ax, fig)
+    buffer = BytesIO()
+    # Flat colours compress well even at zlib level 1, which is several times cheaper than level 6
+    im.reduce(s).save(buffer, format='PNG', compress_level=1)  # box-filter 2x downsample
+    return buffer.getvalue()
+
+@functools.lru_cache(maxsize=None)
+def _empty_chart(chart_type, fmt):
+    """"No ... data available" placeholder, rendered once per chart type and format ("png" or "svg")
+    and shared by every patient who has no readings yet"""
+    chart = _VITALS_CHARTS[chart_type]
+    if fmt == "png":
+        return render_chart_png([], [], chart.title, chart.ylabel, chart.empty_message, chart.png_size)
+    return render_line_svg([], [], chart.ylabel, chart.empty_message).encode()
+
+def _vitals_png(chart_type):
+    """Cached PNG response for one of the patient's vitals charts"""
+    if Image is None:
+        return {"success": False, "message": "Pillow not available"}, 500
+
+    chart = _VITALS_CHARTS[chart_type]
+    conn = get_db()
 
-    if weights:
-        dates = [row['date'] for row in weights]
-        x_pos = list(range(len(dates)))
-        weight_values = [row['weight'] for row in weights]
-        _plot_glow_series(ax, x_pos, weight_values, '#22d3ee', show_slope=True)
-        ax.set_xticks(x_pos)
-        ax.set_xticklabels(dates)
-    else:
-        ax.text(
-            0.5, 0.5, 'No weight data available',
-            transform=ax.transAxes,
-            ha='center', va='center',
-            color='#94a3b8', fontsize=12, fontweight='semibold'
-        )
-        ax.set_xticks([])
-        ax.set_yticks([])
+    def render():
+        dates, series = _vitals_series(chart)
+        conn.close()
+        if not dates:
+            return _empty_chart(chart_type, "png")
+        return render_chart_png(dates, series, chart.title, chart.ylabel, chart.empty_message, chart.png_size)
 
-    ax.set_title('Weight History', color='#e2e8f0', fontsize=13, pad=12, fontweight='bold')
-    ax.set_xlabel('Date', color='#cbd5e1')
-    ax.set_ylabel('Weight (kg)', color='#cbd5e1')
-    plt.xticks(rotation=28, ha='right')
-    plt.tight_layout()
+    return _cached_chart(conn, f"{chart_type}_png", "image/png", render)
 
-    buffer = BytesIO()
-    plt.savefig(
-        buffer,
-        format='png',
-        dpi=120,
-        bbox_inches='tight',
-        pad_inches=0.08,
-        facecolor=fig.get_facecolor(),
-        edgecolor=fig.get_facecolor(),
-        transparent=False
-    )
-    buffer.seek(0)
-    plt.close(fig)
+@app.route("/weight_chart")
+def weight_chart():
+    if "user_id" not in session or session.get("role") != "user":
+        return redirect("/login")
 
-    from flask import make_response
-    response = make_response(buffer.getvalue())
-    response.headers['Content-Type'] = 'image/png'
-    return response
+    return _vitals_png("weight")
 
 @app.route("/height_chart")
 def height_chart():
     if "user_id" not in session or session.get("role") != "user":
         return redirect("/login")
 
-    try:
-        import matplotlib
-        matplotlib.use('Agg')
-        import matplotlib.pyplot as plt
-        from io import BytesIO
-    except ImportError:
-        return {"success": False, "message": "Matplotlib not available"}, 500
-
-    conn = get_db()
-    heights = conn.execute("""
-        SELECT date, height FROM weight_tracking
-        WHERE user_id=? AND height IS NOT NULL
-        ORDER BY date ASC, id ASC
-    """, (session["user_id"],)).fetchall()
-    conn.close()
-
-    fig, ax = plt.subplots(figsize=(10, 5.2), dpi=120)
-    _style_vitals_axes(ax, fig)
-
-    if heights:
-        dates = [row['date'] for row in heights]
-        x_pos = list(range(len(dates)))
-        height_values = [row['height'] for row in heights]
-        _plot_glow_series(ax, x_pos, height_values, '#2dd4bf', show_slope=True)
-        ax.set_xticks(x_pos)
-        ax.set_xticklabels(dates)
-    else:
-        ax.text(
-            0.5, 0.5, 'No height data available',
-            transform=ax.transAxes,
-            ha='center', va='center',
-            color='#94a3b8', fontsize=12, fontweight='semibold'
-        )
-        ax.set_xticks([])
-        ax.set_yticks([])
-
-    ax.set_title('Height History', color='#e2e8f0', fontsize=13, pad=12, fontweight='bold')
-    ax.set_xlabel('Date', color='#cbd5e1')
-    ax.set_ylabel('Height (cm)', color='#cbd5e1')
-    plt.xticks(rotation=28, ha='right')
-    plt.tight_layout()
-
-    buffer = BytesIO()
-    plt.savefig(
-        buffer,
-        format='png',
-        dpi=120,
-        bbox_inches='tight',
-        pad_inches=0.08,
-        facecolor=fig.get_facecolor(),
-        edgecolor=fig.get_facecolor(),
-        transparent=False
-    )
-    buffer.seek(0)
-    plt.close(fig)
-
-    from flask import make_response
-    response = make_response(buffer.getvalue())
-    response.headers['Content-Type'] = 'image/png'
-    return response
+    return _vitals_png("height")
 
 @app.route("/bp_chart")
 def bp_chart():
     if "user_id" not in session or session.get("role") != "user":
         return redirect("/login")
 
-    try:
-        import matplotlib
-        matplotlib.use('Agg')
-        import matplotlib.pyplot as plt
-        from io import BytesIO
-    except ImportError:
-        return {"success": False, "message": "Matplotlib not available"}, 500
-
-    conn = get_db()
-    bp_rows = conn.execute("""
-        SELECT date, bp_systolic, bp_diastolic FROM weight_tracking
-        WHERE user_id=? AND bp_systolic IS NOT NULL AND bp_diastolic IS NOT NULL
-        ORDER BY date ASC, id ASC
-    """, (session["user_id"],)).fetchall()
-    conn.close()
-
-    fig, ax = plt.subplots(figsize=(10, 5.2), dpi=120)
-    _style_vitals_axes(ax, fig)
-
-    if bp_rows:
-        dates = [row['date'] for row in bp_rows]
-        x_pos = list(range(len(dates)))
-        systolic = [row['bp_systolic'] for row in bp_rows]
-        diastolic = [row['bp_diastolic'] for row in bp_rows]
-
-        _plot_glow_series(ax, x_pos, systolic, '#22d3ee', 'Systolic', show_slope=True)
-        _plot_glow_series(ax, x_pos, diastolic, '#38bdf8', 'Diastolic', show_slope=True)
-        ax.set_xticks(x_pos)
-        ax.set_xticklabels(dates)
-        legend = ax.legend(
-            facecolor='#121b2d',
-            edgecolor='#334155',
-            framealpha=0.9,
-            loc='upper left'
-        )
-        for text in legend.get_texts():
-            text.set_color('#cbd5e1')
+    return _vitals_png("bp")
+
+# ---------------- SVG CHART BUILDER ----------------
+_SVG_WIDTH, _SVG_HEIGHT = 800, 420
+_SVG_PLOT = (70, 20, 780, 330)  # left, top, right, bottom of the axes area
+_SVG_FONT = "DejaVu Sans, Arial, sans-serif"
+
+def render_line_svg(x_labels, series, ylabel, empty_message):
+    """
+    Vitals line chart as SVG markup, in the same palette as render_chart_png().
+    series is a list of (legend label or None, values, colour); every series
+    gets its points, a highlighted last value and a dashed trend line.
+    """
+    left, top, right, bottom = _SVG_PLOT
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {_SVG_WIDTH} {_SVG_HEIGHT}" '
+        f'font-family="{_SVG_FONT}">',
+        f'<rect width="{_SVG_WIDTH}" height="{_SVG_HEIGHT}" fill="#0b0f1a"/>',
+        f'<rect x="{left}" y="{top}" width="{right - left}" height="{bottom - top}" fill="#121b2d"/>',
+    ]
+
+    n = len(x_labels)
+    trends = [_trend_line(ys) for _, ys, _ in series]
+    values = [v for _, ys, _ in series for v in ys]
+    values += [t for trend in trends if trend is not None for t in (trend[0], trend[-1])]  # keep trends in view
+    if n and values:
+        lo, hi = _value_range(values)
+
+        def px(i):
+            return (left + right) / 2 if n == 1 else left + (right - left) * (0.03 + 0.94 * i / (n - 1))
+
+        def py(v):
+            return bottom - (v - lo) / (hi - lo) * (bottom - top)
+
+        # Horizontal grid and y tick labels
+        for tick in _nice_ticks(lo, hi):
+            y = py(tick)
+            parts.append(f'<line x1="{left}" y1="{y:.1f}" x2="{right}" y2="{y:.1f}" '
+                         f'stroke="#334155" stroke-opacity="0.22" stroke-width="0.8"/>')
+            parts.append(f'<text x="{left - 8}" y="{y + 3:.1f}" fill="#cbd5e1" font-size="11" '
+                         f'text-anchor="end">{_format_tick(tick)}</text>')
+
+        # Rotated x tick labels, one per reading as in render_chart_png()
+        for i, label in enumerate(x_labels):
+            x = px(i)
+            parts.append(f'<line x1="{x:.1f}" y1="{bottom}" x2="{x:.1f}" y2="{bottom + 4}" stroke="#cbd5e1"/>')
+            parts.append(f'<text x="{x:.1f}" y="{bottom + 16}" fill="#cbd5e1" font-size="11" text-anchor="end" '
+                         f'transform="rotate(-28 {x:.1f} {bottom + 16})">{html.escape(str(label))}</text>')
+
+        for (_, ys, color), trend in zip(series, trends):
+            xs = list(range(len(ys)))
+            if trend is not None:
+                points = " ".join(f"{px(i):.1f},{py(t):.1f}" for i, t in zip(xs, trend))
+                parts.append(f'<polyline points="{points}" fill="none" stroke="#94a3b8" stroke-width="1" '
+                             f'stroke-dasharray="5 4" stroke-opacity="0.45"/>')
+            points = " ".join(f"{px(i):.1f},{py(v):.1f}" for i, v in zip(xs, ys))
+            parts.append(f'<polyline points="{points}" fill="none" stroke="{color}" stroke-width="3" '
+                         f'stroke-opacity="0.95" stroke-linejoin="round" stroke-linecap="round"/>')
+            parts.extend(f'<circle cx="{px(i):.1f}" cy="{py(v):.1f}" r="2.6" fill="{color}" fill-opacity="0.9"/>'
+                         for i, v in zip(xs, ys))
+            if ys:
+                last_x, last_y = px(len(ys) - 1), py(ys[-1])
+                last = _value_label(ys[-1])
+                parts.append(f'<circle cx="{last_x:.1f}" cy="{last_y:.1f}" r="4.2" fill="{color}" '
+                             f'stroke="#0b0f1a" stroke-width="1.1"/>')
+                parts.append(f'<text x="{last_x + 8:.1f}" y="{last_y + 14:.1f}" fill="#e2e8f0" font-size="11" '
+                             f'font-weight="bold">{last}</text>')
+
+        # Legend for multi-series charts
+        labelled = [(label, color) for label, _, color in series if label]
+        if labelled:
+            parts.append('<g class="legend">')
+            parts.append(f'<rect x="{left + 10}" y="{top + 10}" width="110" height="{12 + 20 * len(labelled)}" '
+                         f'rx="4" fill="#121b2d" fill-opacity="0.9" stroke="#334155"/>')
+            for k, (label, color) in enumerate(labelled):
+                y = top + 26 + 20 * k
+                parts.append(f'<line x1="{left + 20}" y1="{y - 4}" x2="{left + 44}" y2="{y - 4}" '
+                             f'stroke="{color}" stroke-width="3"/>')
+                parts.append(f'<text x="{left + 52}" y="{y}" fill="#cbd5e1" font-size="11">{html.escape(label)}</text>')
+            parts.append('</g>')
     else:
-        ax.text(
-            0.5, 0.5, 'No blood pressure data available',
-            transform=ax.transAxes,
-            ha='center', va='center',
-            color='#94a3b8', fontsize=12, fontweight='semibold'
-        )
-        ax.set_xticks([])
-        ax.set_yticks([])
-
-    ax.set_title('Blood Pressure', color='#e2e8f0', fontsize=13, pad=12, fontweight='bold')
-    ax.set_xlabel('Date', color='#cbd5e1')
-    ax.set_ylabel('mmHg', color='#cbd5e1')
-    plt.xticks(rotation=28, ha='right')
-    plt.tight_layout()
-
-    buffer = BytesIO()
-    plt.savefig(
-        buffer,
-        format='png',
-        dpi=120,
-        bbox_inches='tight',
-        pad_inches=0.08,
-        facecolor=fig.get_facecolor(),
-        edgecolor=fig.get_facecolor(),
-        transparent=False
-    )
-    buffer.seek(0)
-    plt.close(fig)
-
-    from flask import make_response
-    response = make_response(buffer.getvalue())
-    response.headers['Content-Type'] = 'image/png'
-    return response
+        parts.append(f'<text x="{(left + right) / 2}" y="{(top + bottom) / 2}" fill="#94a3b8" font-size="15" '
+                     f'font-weight="600" text-anchor="middle" dominant-baseline="middle">{html.escape(empty_message)}</text>')
+
+    # Axes spines and labels
+    parts.append(f'<line x1="{left}" y1="{top}" x2="{left}" y2="{bottom}" stroke="#334155"/>')
+    parts.append(f'<line x1="{left}" y1="{bottom}" x2="{right}" y2="{bottom}" stroke="#334155"/>')
+    parts.append(f'<text x="{(left + right) / 2}" y="{_SVG_HEIGHT - 8}" fill="#cbd5e1" font-size="12" '
+                 f'text-anchor="middle">Date</text>')
+    parts.append(f'<text x="18" y="{(top + bottom) / 2}" fill="#cbd5e1" font-size="12" text-anchor="middle" '
+                 f'transform="rotate(-90 18 {(top + bottom) / 2})">{html.escape(ylabel)}</text>')
+    parts.append('</svg>')
+    return "".join(parts)
 
 @app.route("/vitals_svg/<chart_type>")
 def vitals_svg(chart_type):
     if "user_id" not in session or session.get("role") != "user":
         return redirect("/login")
 
-    try:
-        import matplotlib
-        matplotlib.use('Agg')
-        import matplotlib.pyplot as plt
-        from io import StringIO
-    except ImportError:
-        return {"success": False, "message": "Matplotlib not available"}, 500
+    chart = _VITALS_CHARTS.get(chart_type)
+    if chart is None:
+        return {"success": False, "message": "Invalid chart type"}, 400
 
     conn = get_db()
 
-    if chart_type == "weight":
-        rows = conn.execute("""
-            SELECT date, weight FROM weight_tracking
-            WHERE user_id=? AND weight IS NOT NULL
-            ORDER BY date ASC, id ASC
-        """, (session["user_id"],)).fetchall()
-    elif chart_type == "height":
-        rows = conn.execute("""
-            SELECT date, height FROM weight_tracking
-            WHERE user_id=? AND height IS NOT NULL
-            ORDER BY date ASC, id ASC
-        """, (session["user_id"],)).fetchall()
-    elif chart_type == "bp":
-        rows = conn.execute("""
-            SELECT date, bp_systolic, bp_diastolic FROM weight_tracking
-            WHERE user_id=? AND bp_systolic IS NOT NULL AND bp_diastolic IS NOT NULL
-            ORDER BY date ASC, id ASC
-        """, (session["user_id"],)).fetchall()
-    else:
+    def render():
+        dates, series = _vitals_series(chart)
         conn.close()
-        return {"success": False, "message": "Invalid chart type"}, 400
-
-    conn.close()
+        if not dates:
+            return _empty_chart(chart_type, "svg")
+        return render_line_svg(dates, series, chart.ylabel, chart.empty_message).encode()
 
-    fig, ax = plt.subplots(figsize=(10, 5.2), dpi=120)
-    _style_vitals_axes(ax, fig)
-
-    if chart_type == "weight":
-        if rows:
-            dates = [r["date"] for r in rows]
-            x_pos = list(range(len(dates)))
-            y = [r["weight"] for r in rows]
-            _plot_glow_series(ax, x_pos, y, '#22d3ee', show_slope=True)
-            ax.set_xticks(x_pos)
-            ax.set_xticklabels(dates)
-        else:
-            ax.text(0.5, 0.5, 'No weight data available', transform=ax.transAxes,
-                    ha='center', va='center', color='#94a3b8', fontsize=12, fontweight='semibold')
-            ax.set_xticks([])
-            ax.set_yticks([])
-        ax.set_ylabel('Weight (kg)', color='#cbd5e1')
-
-    elif chart_type == "height":
-        if rows:
-            dates = [r["date"] for r in rows]
-            x_pos = list(range(len(dates)))
-            y = [r["height"] for r in rows]
-            _plot_glow_series(ax, x_pos, y, '#2dd4bf', show_slope=True)
-            ax.set_xticks(x_pos)
-            ax.set_xticklabels(dates)
-        else:
-            ax.text(0.5, 0.5, 'No height data available', transform=ax.transAxes,
-                    ha='center', va='center', color='#94a3b8', fontsize=12, fontweight='semibold')
-            ax.set_xticks([])
-            ax.set_yticks([])
-        ax.set_ylabel('Height (cm)', color='#cbd5e1')
-
-    else:
-        if rows:
-            dates = [r["date"] for r in rows]
-            x_pos = list(range(len(dates)))
-            systolic = [r["bp_systolic"] for r in rows]
-            diastolic = [r["bp_diastolic"] for r in rows]
-            _plot_glow_series(ax, x_pos, systolic, '#22d3ee', 'Systolic', show_slope=True)
-            _plot_glow_series(ax, x_pos, diastolic, '#38bdf8', 'Diastolic', show_slope=True)
-            ax.set_xticks(x_pos)
-            ax.set_xticklabels(dates)
-            legend = ax.legend(facecolor='#121b2d', edgecolor='#334155', framealpha=0.9, loc='upper left')
-            for t in legend.get_texts():
-                t.set_color('#cbd5e1')
-        else:
-            ax.text(0.5, 0.5, 'No blood pressure data available', transform=ax.transAxes,
-                    ha='center', va='center', color='#94a3b8', fontsize=12, fontweight='semibold')
-            ax.set_xticks([])
-            ax.set_yticks([])
-        ax.set_ylabel('mmHg', color='#cbd5e1')
-
-    ax.set_xlabel('Date', color='#cbd5e1')
-    plt.xticks(rotation=28, ha='right')
-    plt.tight_layout()
-
-    svg_buffer = StringIO()
-    plt.savefig(
-        svg_buffer,
-        format='svg',
-        bbox_inches='tight',
-        pad_inches=0.08,
-        facecolor=fig.get_facecolor(),
-        edgecolor=fig.get_facecolor(),
-        transparent=False
-    )
-    plt.close(fig)
-
-    import re
-    svg_markup = re.sub(r'<title>.*?</title>', '', svg_buffer.getvalue(), flags=re.DOTALL)
-
-    from flask import make_response
-    response = make_response(svg_markup)
-    response.headers['Content-Type'] = 'image/svg+xml'
-    return response
+    return _cached_chart(conn, f"{chart_type}_svg", "image/svg+xml", render)
 
 # ---------------- SERVER-SIDE NOTIFICATIONS ----------------
 @app.route("/send_notification", methods=["POST"])
@@ -2724,7 +3240,7 @@ def send_notification():
     if not message:
         return {"success": False, "message": "Message is required"}, 400
 
-    conn = get_db()
+    conn = get_db(write=True)
 
     # If target_user_id is provided, send to specific user, otherwise send to current user
     user_id = target_user_id if target_user_id else session["user_id"]
@@ -2748,29 +3264,29 @@ def view_notifications():
         return redirect("/login")
 
     conn = get_db()
-    # Mark patient notifications as seen when page is opened
-    conn.execute("""
-        UPDATE notifications
-        SET read=1
-        WHERE user_id=? AND read=0
-    """, (session["user_id"],))
+    # Mark patient notifications as seen when page is opened. The trigger-kept unread
+    # counter says whether there is anything to mark, so most visits never take the writer;
+    # otherwise the UPDATE and the SELECT below share one write transaction.
+    unread = conn.execute("SELECT unread_notifications FROM users WHERE id=?", (session["user_id"],)).fetchone()
+    if unread and unread[0]:
+        conn = begin_immediate(get_db(write=True))
+        conn.execute("""
+            UPDATE notifications
+            SET read=1
+            WHERE user_id=? AND read=0
+        """, (session["user_id"],))
 
     notifications = conn.execute("""
         SELECT * FROM notifications
         WHERE user_id=?
           AND type!='login_alert'
           AND type!='aqi_alert'
-        ORDER BY created_at DESC
+        ORDER BY created_at DESC, id DESC
     """, (session["user_id"],)).fetchall()
     conn.commit()
     conn.close()
 
-    # Use stack (list) for LIFO ordering of notifications
-    notification_stack = []
-    for notification in notifications:
-        notification_stack.append(notification)
-
-    return render_template("notifications.html", notifications=notification_stack)
+    return render_template("notifications.html", notifications=notifications)
 
 # ---------------- GET PATIENT PRESCRIPTIONS ----------------
 @app.route("/get_patient_prescriptions")
@@ -2789,7 +3305,7 @@ def get_patient_prescriptions():
     """, (session["user_id"],)).fetchall()
     conn.close()
 
-    return {"success": True, "prescriptions": [dict(p) for p in prescriptions]}
+    return {"success": True, "prescriptions": prescriptions}
 
 # ---------------- PATIENT PRESCRIPTIONS PAGE ----------------
 @app.route("/patient_prescriptions")
@@ -2805,21 +3321,39 @@ def patient_prescriptions():
         JOIN appointments a ON p.appointment_id = a.id
         JOIN doctors d ON a.doctor_id = d.id
         WHERE a.patient_id=? AND a.status='accepted'
-        ORDER BY p.created_at DESC
+        ORDER BY date_key DESC, p.created_at DESC
     """, (session["user_id"],)).fetchall()
     conn.close()
 
-    # Group prescriptions by date
-    prescriptions_by_date = {}
-    for prescription in prescriptions:
-        date = prescription['date_key']
-        if date not in prescriptions_by_date:
-            prescriptions_by_date[date] = []
-        prescriptions_by_date[date].append(dict(prescription))
-
-    return render_template("patient_prescriptions.html", prescriptions_by_date=prescriptions_by_date)
+    # The template groups the rows by date_key with Jinja's groupby filter
+    return render_template("patient_prescriptions.html", prescriptions=prescriptions)
 
 # ---------------- PRESCRIPTION BILL ----------------
+# Line totals and the running subtotal come out of SQLite; missing or zero tablets/duration
+# count as 1 and a missing price as 0, as the bill has always treated them
+_BILL_LINES_SQL = """
+    SELECT medicine_name, tablets, price, duration,
+           price * duration * tablets AS total,
+           SUM(price * duration * tablets) OVER () AS subtotal,
+           patient_fname, patient_lname, doctor_fname, doctor_lname, specialty, appointment_date
+    FROM (
+        SELECT p.medicine_name,
+               COALESCE(NULLIF(p.tablets, 0), 1) AS tablets,
+               COALESCE(p.price, 0) AS price,
+               COALESCE(NULLIF(p.duration, 0), 1) AS duration,
+               a.date as appointment_date,
+               u.fname as patient_fname, u.lname as patient_lname,
+               d.fname as doctor_fname, d.lname as doctor_lname, d.specialty,
+               p.created_at
+        FROM prescriptions p
+        JOIN appointments a ON p.appointment_id = a.id
+        JOIN users u ON a.patient_id = u.id
+        JOIN doctors d ON a.doctor_id = d.id
+        WHERE p.appointment_id=?
+    )
+    ORDER BY created_at ASC
+"""
+
 @app.route("/prescription_bill/<int:appointment_id>")
 def prescription_bill(appointment_id):
     if "user_id" not in session or session.get("role") != "user":
@@ -2838,18 +3372,8 @@ def prescription_bill(appointment_id):
         flash("Appointment not found or access denied.", "danger")
         return redirect("/patient_prescriptions")
 
-    # Get prescription details
-    prescriptions = conn.execute("""
-        SELECT p.*, a.date as appointment_date,
-               u.fname as patient_fname, u.lname as patient_lname,
-               d.fname as doctor_fname, d.lname as doctor_lname, d.specialty
-        FROM prescriptions p
-        JOIN appointments a ON p.appointment_id = a.id
-        JOIN users u ON a.patient_id = u.id
-        JOIN doctors d ON a.doctor_id = d.id
-        WHERE p.appointment_id=?
-        ORDER BY p.created_at ASC
-    """, (appointment_id,)).fetchall()
+    # Get prescription lines with their totals
+    prescriptions = conn.execute(_BILL_LINES_SQL, (appointment_id,)).fetchall()
 
     conn.close()
 
@@ -2857,25 +3381,9 @@ def prescription_bill(appointment_id):
         flash("No prescriptions found for this appointment.", "warning")
         return redirect("/patient_prescriptions")
 
-    # Calculate bill details
-    medicines = []
-    subtotal = 0
-
-    for prescription in prescriptions:
-        price = prescription['price'] or 0
-        duration = prescription['duration'] or 1
-        tablets = prescription['tablets'] or 1
-        total = price * duration * tablets
-
-        medicines.append({
-            'medicine_name': prescription['medicine_name'],
-            'tablets': tablets,
-            'price': price,
-            'duration': duration,
-            'total': total
-        })
-
-        subtotal += total
+    medicines = [{key: p[key] for key in ('medicine_name', 'tablets', 'price', 'duration', 'total')}
+                 for p in prescriptions]
+    subtotal = prescriptions[0]['subtotal']
 
     # GST calculation (18% for medicines in India)
     gst_rate = 18
@@ -2902,7 +3410,7 @@ def save_vitals(patient_id):
     if "user_id" not in session or session.get("role") != "doctor":
         return {"success": False, "message": "Unauthorized"}, 401
 
-    conn = get_db()
+    conn = get_db(write=True)
     try:
         data = request.get_json()
         weight = data.get("weight")
@@ -2913,7 +3421,6 @@ def save_vitals(patient_id):
         if weight is None or height is None or bp_systolic is None or bp_diastolic is None:
             return {"success": False, "message": "All fields are required"}, 400
 
-        from datetime import datetime
         date = datetime.now().strftime('%Y-%m-%d')
 
         conn.execute("""
@@ -2924,13 +3431,19 @@ def save_vitals(patient_id):
 
         return {"success": True, "message": "Vitals saved successfully"}
 
-    except Exception as e:
-        print(f"Error saving vitals: {e}")
+    except Exception:
+        app.logger.exception("Error saving vitals")
         return {"success": False, "message": "Error saving vitals"}, 500
     finally:
         conn.close()
 
 # ---------------- SAVE NOTES ----------------
+# The ownership check is the SELECT itself: no matching appointment, nothing upserted
+_SAVE_NOTES_SQL = """
+    INSERT INTO consultation_notes (appointment_id, notes)
+    SELECT id, ? FROM appointments WHERE id=? AND doctor_id=?
+    ON CONFLICT(appointment_id) DO UPDATE SET notes=excluded.notes
+"""
 @app.route("/save_notes/<int:appointment_id>", methods=["POST"])
 def save_notes(appointment_id):
     if "user_id" not in session or session.get("role") != "doctor":
@@ -2943,31 +3456,22 @@ def save_notes(appointment_id):
         if not notes:
             return {"success": False, "message": "Notes are required"}, 400
 
-        conn = get_db()
+        conn = get_db(write=True)
 
-        # Verify appointment belongs to doctor
-        appointment = conn.execute("""
-            SELECT id FROM appointments
-            WHERE id=? AND doctor_id=(SELECT id FROM doctors WHERE user_id=?)
-        """, (appointment_id, session["user_id"])).fetchone()
+        # Insert or update notes in place, only for appointments that belong to the doctor
+        saved = conn.execute(_SAVE_NOTES_SQL, (notes, appointment_id, current_doctor_id(conn))).rowcount
 
-        if not appointment:
+        if not saved:
             conn.close()
             return {"success": False, "message": "Appointment not found or access denied"}, 404
 
-        # Insert or update notes
-        conn.execute("""
-            INSERT OR REPLACE INTO consultation_notes (appointment_id, notes)
-            VALUES (?, ?)
-        """, (appointment_id, notes))
-
         conn.commit()
         conn.close()
 
         return {"success": True, "message": "Notes saved successfully"}
 
-    except Exception as e:
-        print(f"Error saving notes: {e}")
+    except Exception:
+        app.logger.exception("Error saving notes")
         return {"success": False, "message": "Error saving notes"}, 500
 
 # ---------------- GET CONSULTATION NOTES ----------------
@@ -3022,62 +3526,28 @@ def get_patient_vitals():
     """, (session["user_id"],)).fetchall()
     conn.close()
 
-    return {"success": True, "vitals": [dict(v) for v in vitals]}
+    return {"success": True, "vitals": vitals}
 
 # ---------------- PROFILE PROGRESS CALCULATION ----------------
+# Form field -> percentage it adds when filled in, on top of a 25% base (same weights as the JavaScript)
+_PROFILE_WEIGHTS = (
+    ("specialty", 7), ("fees", 7),  # required fields
+    ("age", 3), ("experience_years", 3), ("qualification", 7), ("license", 7),
+    ("hospital_name", 4), ("city", 4), ("state", 4), ("landmark", 3), ("full_address", 7),
+    ("pincode", 4), ("latitude", 3), ("longitude", 3), ("staff_count", 3), ("languages", 3),
+    ("reviews", 6), ("awards", 6), ("emergency_contact", 5),
+)
+
 @app.route("/calculate_profile_progress", methods=["POST"])
 def calculate_profile_progress():
     """Calculate doctor profile completion progress based on form data"""
     if "user_id" not in session or session.get("role") != "doctor":
         return {"success": False, "message": "Unauthorized"}, 401
-    
-    # Get form data from request
-    specialty = request.form.get("specialty", "").strip()
-    fees = request.form.get("fees", "").strip()
-    age = request.form.get("age", "").strip()
-    experience_years = request.form.get("experience_years", "").strip()
-    qualification = request.form.get("qualification", "").strip()
-    license_no = request.form.get("license", "").strip()
-    hospital_name = request.form.get("hospital_name", "").strip()
-    city = request.form.get("city", "").strip()
-    state = request.form.get("state", "").strip()
-    landmark = request.form.get("landmark", "").strip()
-    full_address = request.form.get("full_address", "").strip()
-    pincode = request.form.get("pincode", "").strip()
-    latitude = request.form.get("latitude", "").strip()
-    longitude = request.form.get("longitude", "").strip()
-    staff_count = request.form.get("staff_count", "").strip()
-    languages = request.form.get("languages", "").strip()
-    reviews = request.form.get("reviews", "").strip()
-    awards = request.form.get("awards", "").strip()
-    emergency_contact = request.form.get("emergency_contact", "").strip()
-
-    # Calculate progress percentage (same logic as JavaScript)
-    percent = 25  # Base percentage
-
-    if specialty: percent += 7  # Specialty is required
-    if fees: percent += 7  # Fees is required
-    if age: percent += 3
-    if experience_years: percent += 3
-    if qualification: percent += 7
-    if license_no: percent += 7
-    if hospital_name: percent += 4
-    if city: percent += 4
-    if state: percent += 4
-    if landmark: percent += 3
-    if full_address: percent += 7
-    if pincode: percent += 4
-    if latitude: percent += 3
-    if longitude: percent += 3
-    if staff_count: percent += 3
-    if languages: percent += 3
-    if reviews: percent += 6
-    if awards: percent += 6
-    if emergency_contact: percent += 5
-
-    percent = min(percent, 100)  # Cap at 100%
-
-    return {"success": True, "progress": percent}
+
+    form = request.form
+    percent = 25 + sum(weight for field, weight in _PROFILE_WEIGHTS if form.get(field, "").strip())
+
+    return {"success": True, "progress": min(percent, 100)}  # Cap at 100%
 
 # ---------------- TEST SAVE VITALS ----------------
 def test_save_vitals(patient_id, weight, height, bp_systolic, bp_diastolic):
@@ -3134,6 +3604,8 @@ if __name__ == "__main__":
     print("Latest vitals record:", row)
     conn.close()
 
-    app.run(debug=True)
+    # One thread per request; each checks out its own pooled WAL connection,
+    # so requests overlap their database I/O (sqlite3 releases the GIL while executing)
+    app.run(debug=True, threaded=True)
 
 
@@ -5,6 +5,15 @@ c = conn.cursor()
 
 tables = ['users', 'chats', 'categories', 'doctors', 'appointments', 'notifications', 'wallets', 'payments', 'weight_tracking', 'prescriptions', 'consultation_notes']
 
+# Counter tables the app creates on first start; cleared with the data they count when present
+existing = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+tables += [t for t in ('doctor_patient_visits', 'doctor_patient_counts') if t in existing]
+
+# Freed pages don't need zeroing: VACUUM below rebuilds the file anyway
+c.execute("PRAGMA secure_delete=OFF")
+
+# All deletes share one transaction, so the journal is synced once at COMMIT
+c.execute("BEGIN")
 for table in tables:
     try:
         c.execute(f"DELETE FROM {table}")
@@ -13,6 +22,9 @@ for table in tables:
         print(f"Error clearing {table}: {e}")
 
 conn.commit()
+
+# Give the emptied pages back to the filesystem
+c.execute("VACUUM")
 conn.close()
 
 print("All data cleared from tables.")